@@ -1,78 +1,201 @@
 import os
 import cv2
 import json
+import math
+import mmap
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library encoder.
+    orjson = None
 import numpy as np
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 logging.basicConfig(level=logging.INFO)
 
+# Images larger than this (in pixels) are downsampled for the interactive preview.
+PREVIEW_MAX_PIXELS = 1_000_000
+
+# Trackbar polling interval (ms): fast while dragging, backing off to the idle maximum.
+POLL_ACTIVE_MS = 16
+POLL_BASE_MS = 50
+POLL_IDLE_MAX_MS = 200
+
+# Rescale previews on the GPU through OpenCV's transparent API when OpenCL is available.
+USE_OPENCL = cv2.ocl.haveOpenCL()
+
+# Every possible 16-bit value, shared by all lookup-table builds.
+_LUT_INDEX = np.arange(65536, dtype=np.float32)
+
+def build_display_lut(min_val, max_val, out=None):
+    """Build a 65536-entry lookup table mapping 16-bit values in [min_val, max_val] to 0-255."""
+    lut = (_LUT_INDEX - min_val) * (255.0 / max(1, max_val - min_val))
+    np.clip(lut, 0, 255, out=lut)
+    if out is None:
+        return lut.astype(np.uint8)
+    np.copyto(out, lut, casting="unsafe")
+    return out
+
+def rescale_preview(img, min_val, max_val, out, lut=None):
+    """Map a 16-bit preview image to 8-bit for the given Min/Max, writing into `out`."""
+    lut = build_display_lut(min_val, max_val, out=lut)
+    return np.take(lut, img, out=out)
+
+def rescale_preview_umat(img_umat, min_val, max_val):
+    """Map a 16-bit preview UMat to 8-bit for the given Min/Max on the OpenCL device."""
+    alpha = 255.0 / max(1, max_val - min_val)
+    return cv2.convertScaleAbs(img_umat, alpha=alpha, beta=-min_val * alpha)
+
+def read_image_mmap(path):
+    """
+    Decode an image from a memory-mapped file so the OS can page data in while OpenCV decodes.
+    Returns None if the file cannot be read or decoded, like cv2.imread.
+    """
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            buffer = np.frombuffer(mm, dtype=np.uint8)
+            img = cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+            # Drop the view before the map is closed.
+            del buffer
+    except (OSError, ValueError):
+        return None
+    return img
+
+def load_preview_image(path):
+    """
+    Load a 16-bit composite image for the black/white preview, downsampling it if it is large.
+    Returns None if the image cannot be loaded; raises ValueError if it is not 16-bit.
+    """
+    img = read_image_mmap(path)
+    if img is None:
+        logging.warning(f"Could not load image: {os.path.basename(path)}. Skipping.")
+        return None
+    if img.dtype != np.uint16:
+        raise ValueError(f"Image {os.path.basename(path)} must be 16-bit grayscale.")
+    
+    # Downsample large images once; the trackbars only record Min/Max,
+    # so the full-resolution image is never needed for the preview.
+    height, width = img.shape[:2]
+    if height * width > PREVIEW_MAX_PIXELS:
+        scale = math.sqrt(PREVIEW_MAX_PIXELS / (height * width))
+        img = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img
+
 def adjust_black_white_cv2(image_dir):
     """
-    Interactive adjustment of black and white points for each PNG image (each channel) in a directory.
-    For each image, a window is opened with trackbars to adjust Min and Max values. The window title includes the image name.
-    When you close the window, the adjustments are saved.
+    Interactive adjustment of black and white points for each composite image (each channel) in a directory.
+    All images are opened together, each in its own window with trackbars to adjust Min and Max values.
+    The window title includes the image name. When you close a window, its adjustments are saved.
     
     Returns:
         dict: Dictionary mapping each image name (or channel) to its black/white adjustment values.
     """
-    # List all PNG files in the directory
-    image_paths = sorted([os.path.join(image_dir, f) for f in os.listdir(image_dir) if f.endswith(".png")])
+    # List all composite images (TIFF, or PNG from older runs) in the directory
+    with os.scandir(image_dir) as entries:
+        image_paths = sorted(e.path for e in entries if e.name.endswith((".tif", ".png")) and e.is_file())
     if not image_paths:
-        raise ValueError(f"No PNG files found in directory: {image_dir}")
+        raise ValueError(f"No composite images found in directory: {image_dir}")
     
     black_white_points = {}
+    windows = {}
     
-    # Process each image sequentially
-    for idx, path in enumerate(image_paths):
-        image_name = os.path.basename(path)
-        logging.info(f"Adjust black and white points for {image_name}.")
-        
-        # Load image
-        img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    # Decode and validate all images in parallel; OpenCV releases the GIL while decoding images.
+    with ThreadPoolExecutor(max_workers=min(len(image_paths), os.cpu_count() or 1)) as executor:
+        images = list(executor.map(load_preview_image, image_paths))
+    
+    # Open a window for every image so all channels can be adjusted side by side.
+    for path, img in zip(image_paths, images):
         if img is None:
-            logging.warning(f"Could not load image: {image_name}. Skipping.")
             continue
-        if img.dtype != np.uint16:
-            raise ValueError(f"Image {image_name} must be 16-bit grayscale.")
+        image_name = os.path.basename(path)
+        logging.info(f"Adjust black and white points for {image_name}.")
         
         # Create a window for this image with a unique name
         window_name = f"Adjust Black/White - {image_name}"
         cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
         
-        # Define a dummy callback for the trackbars
-        def nothing(x):
-            pass
-        
-        # Create trackbars for Min and Max values
-        cv2.createTrackbar("Min", window_name, 0, 65535, nothing)
-        cv2.createTrackbar("Max", window_name, 65535, 65535, nothing)
+        # Convert the 16-bit image to an 8-bit image for display (computed once per image)
+        display_img = cv2.convertScaleAbs(img, alpha=1 / 256.0)
         
-        # Convert the 16-bit image to an 8-bit image for display
-        display_img = (img / 256).astype(np.uint8)
-        cv2.imshow(window_name, display_img)
+        state = {
+            "window_name": window_name,
+            "img": img,
+            "display_img": display_img,
+            # Preallocated 8-bit buffers reused for every redraw.
+            "out": np.empty(img.shape, dtype=np.uint8),
+            "lut": np.empty(65536, dtype=np.uint8),
+            # Current trackbar values; the callbacks flag the window as dirty on change.
+            "min": 0,
+            "max": 65535,
+            "dirty": False,
+        }
+        if USE_OPENCL:
+            # Upload once; every redraw then stays on the GPU.
+            state["img_umat"] = cv2.UMat(img)
+        windows[image_name] = state
         
-        logging.info("Adjust the black and white points for this channel, then close the window to save adjustments.")
+        def on_min(value, state=state):
+            state["min"] = value
+            state["dirty"] = True
         
-        # Continuously update the display while the window is open.
-        while cv2.getWindowProperty(window_name, cv2.WND_PROP_VISIBLE) > 0:
-            min_val = cv2.getTrackbarPos("Min", window_name)
-            max_val = cv2.getTrackbarPos("Max", window_name)
-            if min_val >= max_val:
-                # If the range is invalid, show the original display image.
-                updated_img = display_img.copy()
-            else:
-                # Adjust the image: clip and scale to 0-255 for visualization.
-                adjusted = np.clip(img, min_val, max_val)
-                updated_img = ((adjusted - min_val) / max(1, max_val - min_val) * 255).astype(np.uint8)
-            cv2.imshow(window_name, updated_img)
-            cv2.waitKey(50)  # Update every 50ms
+        def on_max(value, state=state):
+            state["max"] = value
+            state["dirty"] = True
         
-        # Once the window is closed, retrieve the final trackbar values.
-        final_min = cv2.getTrackbarPos("Min", window_name)
-        final_max = cv2.getTrackbarPos("Max", window_name)
-        black_white_points[image_name] = {"Min": final_min, "Max": final_max}
-        cv2.destroyWindow(window_name)
-        logging.info(f"Saved adjustments for {image_name}: Min={final_min}, Max={final_max}")
+        # Create trackbars for Min and Max values
+        cv2.createTrackbar("Min", window_name, 0, 65535, on_min)
+        cv2.createTrackbar("Max", window_name, 65535, 65535, on_max)
+        cv2.imshow(window_name, display_img)
+    
+    if not windows:
+        return black_white_points
+    
+    logging.info("Adjust the black and white points for each channel, then close the windows to save adjustments.")
+    
+    # Rescaling runs on a thread pool (NumPy releases the GIL); imshow stays on this thread.
+    max_workers = min(len(windows), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Continuously update the displays while any window is open.
+        idle_ticks = 0
+        while windows:
+            changed = False
+            futures = {}
+            for image_name, state in list(windows.items()):
+                window_name = state["window_name"]
+                if cv2.getWindowProperty(window_name, cv2.WND_PROP_VISIBLE) <= 0:
+                    # Once the window is closed, keep the final trackbar values.
+                    final_min = state["min"]
+                    final_max = state["max"]
+                    black_white_points[image_name] = {"Min": final_min, "Max": final_max}
+                    cv2.destroyWindow(window_name)
+                    del windows[image_name]
+                    logging.info(f"Saved adjustments for {image_name}: Min={final_min}, Max={final_max}")
+                    continue
+                
+                # Only rescale and redraw when a trackbar callback reported a change.
+                if not state["dirty"]:
+                    continue
+                state["dirty"] = False
+                min_val, max_val = state["min"], state["max"]
+                changed = True
+                if min_val >= max_val:
+                    # If the range is invalid, show the original display image.
+                    cv2.imshow(window_name, state["display_img"])
+                elif "img_umat" in state:
+                    cv2.imshow(window_name, rescale_preview_umat(state["img_umat"], min_val, max_val))
+                else:
+                    future = executor.submit(
+                        rescale_preview, state["img"], min_val, max_val, state["out"], state["lut"]
+                    )
+                    futures[future] = window_name
+            
+            for future in as_completed(futures):
+                cv2.imshow(futures[future], future.result())
+            
+            # Poll quickly while the user is dragging and back off gradually when idle.
+            idle_ticks = 0 if changed else idle_ticks + 1
+            poll_ms = POLL_ACTIVE_MS if changed else min(POLL_IDLE_MAX_MS, POLL_BASE_MS + idle_ticks * 10)
+            cv2.waitKey(poll_ms)
     
     return black_white_points
 
@@ -83,8 +206,12 @@ def save_black_white_points(black_white_points, output_path="black_white_points.
     directory = os.path.dirname(output_path)
     if directory:
         os.makedirs(directory, exist_ok=True)
-    with open(output_path, "w") as f:
-        json.dump(black_white_points, f, indent=4)
+    if orjson is not None:
+        with open(output_path, "wb") as f:
+            f.write(orjson.dumps(black_white_points, option=orjson.OPT_INDENT_2))
+    else:
+        with open(output_path, "w") as f:
+            json.dump(black_white_points, f, indent=2)
     logging.info(f"Saved black-and-white points to {output_path}")
 
 if __name__ == "__main__":
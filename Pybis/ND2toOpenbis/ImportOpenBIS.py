@@ -1,13 +1,45 @@
 import os
 import json
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library decoder.
+    orjson = None
 import getpass
+import hashlib
 from datetime import datetime
 import logging
 from Metadataextractionnd2 import extract_nd2_metadata
 from pybis import Openbis
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logging.basicConfig(level=logging.INFO)
 
+# Experiments already fetched, keyed by (session token, experiment identifier).
+_experiment_cache = {}
+
+# Sidecar file (next to the metadata CSV) recording what was last uploaded per experiment.
+UPLOAD_MANIFEST_NAME = ".openbis_uploads.json"
+
+# Outcomes returned by create_experimental_step_with_dataset.
+UPLOAD_DONE = "uploaded"
+UPLOAD_SKIPPED = "skipped"
+UPLOAD_FAILED = "failed"
+
+def configure_openbis_session(openbis_instance):
+    """
+    Mount a pooled keep-alive HTTP adapter on the pybis requests session, if it exposes one,
+    so consecutive REST calls reuse the TLS connection instead of re-handshaking.
+    """
+    session = getattr(openbis_instance, "session", None) or getattr(openbis_instance, "_session", None)
+    if not isinstance(session, requests.Session):
+        logging.debug("pybis does not expose a requests session; keeping its default connection handling.")
+        return
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=Retry(total=2, backoff_factor=0.2))
+    session.mount("https://", adapter)
+    session.headers["Connection"] = "keep-alive"
+
 def authenticate_with_openbis():
     """
     Authenticate with OpenBIS using user-provided credentials.
@@ -19,16 +51,71 @@ def authenticate_with_openbis():
         raise ValueError("All fields (host, username, and password) must be provided.")
     openbis_instance = Openbis(openbis_host)
     openbis_instance.login(username, password)
+    configure_openbis_session(openbis_instance)
     logging.info("Authentication successful!")
     return openbis_instance
 
+def get_experiment_cached(openbis_instance, experiment_identifier):
+    """
+    Return the experiment for the given identifier, fetching it from OpenBIS only once per session.
+    """
+    key = (getattr(openbis_instance, "token", None), experiment_identifier)
+    experiment = _experiment_cache.get(key)
+    if experiment is None:
+        experiment = openbis_instance.get_experiment(experiment_identifier)
+        if experiment:
+            _experiment_cache[key] = experiment
+    return experiment
+
+def file_sha256(path, chunk_size=1 << 20):
+    """Return the SHA-256 hex digest of a file."""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+def upload_fingerprint(attachment_files, file_info, results_html):
+    """Hash the attachment files and step properties that make up one upload."""
+    fingerprint = {os.path.basename(path): file_sha256(path) for path in attachment_files}
+    fingerprint["__properties__"] = hashlib.sha256((file_info + results_html).encode("utf-8")).hexdigest()
+    return fingerprint
+
+def load_upload_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable upload manifest '{manifest_path}': {e}")
+        return {}
+
 def create_experimental_step_with_dataset(
-    openbis_instance, experiment_identifier, step_name, file_info, metadata_csv_path, composite_image_paths, results_html
+    openbis_instance, experiment_identifier, step_name, file_info, metadata_csv_path, composite_image_paths, results_html,
+    skip_existing=True
 ):
     """
     Create an experimental step, attach metadata as a dataset, and include composite images as attachments.
+    If skip_existing is True and identical files and properties were already uploaded to this
+    experiment (per the local upload manifest), nothing is uploaded again. The manifest only
+    records uploads made from this output folder, so pass skip_existing=False to force a re-upload.
+
+    Returns UPLOAD_DONE, UPLOAD_SKIPPED or UPLOAD_FAILED.
     """
-    experiment = openbis_instance.get_experiment(experiment_identifier)
+    attachment_files = [metadata_csv_path] + composite_image_paths
+    manifest_path = os.path.join(os.path.dirname(metadata_csv_path), UPLOAD_MANIFEST_NAME)
+    manifest = fingerprint = None
+    if skip_existing:
+        manifest = load_upload_manifest(manifest_path)
+        fingerprint = upload_fingerprint(attachment_files, file_info, results_html)
+        if manifest.get(experiment_identifier) == fingerprint:
+            logging.info(f"Identical files were already uploaded to '{experiment_identifier}'. Skipping upload.")
+            return UPLOAD_SKIPPED
+    
+    experiment = get_experiment_cached(openbis_instance, experiment_identifier)
     if not experiment:
         raise ValueError(f"Experiment with identifier '{experiment_identifier}' does not exist. Aborting.")
     step_code = f"{step_name}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
@@ -48,10 +135,9 @@ def create_experimental_step_with_dataset(
         logging.info(f"Sample '{step_code}' saved successfully.")
     except Exception as e:
         logging.error(f"Failed to save sample '{step_code}': {e}")
-        return
+        return UPLOAD_FAILED
     
     try:
-        attachment_files = [metadata_csv_path] + composite_image_paths
         dataset = openbis_instance.new_dataset(
             type="ATTACHMENT",
             sample=sample.identifier,
@@ -65,28 +151,49 @@ def create_experimental_step_with_dataset(
         logging.info(f"Dataset created and linked to sample '{step_code}'.")
     except Exception as e:
         logging.error(f"Failed to create dataset for sample '{step_code}': {e}")
-        return
+        return UPLOAD_FAILED
+    
+    if fingerprint is not None:
+        manifest[experiment_identifier] = fingerprint
+        try:
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+        except OSError as e:
+            # The upload itself succeeded; only the next run's skip check is affected.
+            logging.warning(f"Could not update upload manifest '{manifest_path}': {e}")
+    return UPLOAD_DONE
 
-def generate_results_html(json_path, composite_image_paths, main_folder_name):
+def generate_results_html(black_white_points, composite_image_paths, main_folder_name):
     """
     Generate an HTML table summarizing the results, including black/white points and main folder info.
     """
+    parts = ["<h3>Experimental Results</h3><table border='1'><tr><th>Channel</th><th>Black Point</th><th>White Point</th></tr>"]
+    parts.extend(
+        f"<tr><td>{channel_name}</td><td>{points['Min']}</td><td>{points['Max']}</td></tr>"
+        for channel_name, points in black_white_points.items()
+    )
+    parts.append("</table>")
+    parts.append(f"<p><strong>Main Folder:</strong> {main_folder_name}</p>")
+    return "".join(parts)
+
+def generate_results_html_from_json(json_path, composite_image_paths, main_folder_name):
+    """
+    Load the black/white points from a JSON file and generate the results HTML table.
+    """
     if not os.path.exists(json_path):
         raise FileNotFoundError(f"JSON file not found at path: {json_path}")
-    with open(json_path, 'r') as f:
-        black_white_points = json.load(f)
+    if orjson is not None:
+        with open(json_path, 'rb') as f:
+            black_white_points = orjson.loads(f.read())
+    else:
+        with open(json_path, 'r') as f:
+            black_white_points = json.load(f)
     logging.info(f"Loaded black-white points: {black_white_points}")
-    
-    html = "<h3>Experimental Results</h3><table border='1'><tr><th>Channel</th><th>Black Point</th><th>White Point</th></tr>"
-    for channel_name, points in black_white_points.items():
-        html += f"<tr><td>{channel_name}</td><td>{points['Min']}</td><td>{points['Max']}</td></tr>"
-    html += "</table>"
-    html += f"<p><strong>Main Folder:</strong> {main_folder_name}</p>"
-    return html
+    return generate_results_html(black_white_points, composite_image_paths, main_folder_name)
 
 def main():
     openbis_instance = authenticate_with_openbis()
-    composite_image_paths = [f"output/composite_channel_ch{i}.png" for i in range(4)]
+    composite_image_paths = [f"output/composite_channel_ch{i}.tif" for i in range(4)]
     json_path = "output/black_white_points.json"
     main_folder_name = "output_images"
     default_experiment_identifier = "/AKIRSCHNER/PYBIS/PYBIS_EXP_1"
@@ -95,8 +202,8 @@ def main():
         logging.error("Invalid ND2 file or extraction error. Exiting.")
         return
     step_name = os.path.basename(nd2_file_path).replace('.nd2', '')
-    results_html = generate_results_html(json_path, composite_image_paths, main_folder_name)
-    create_experimental_step_with_dataset(
+    results_html = generate_results_html_from_json(json_path, composite_image_paths, main_folder_name)
+    status = create_experimental_step_with_dataset(
         openbis_instance=openbis_instance,
         experiment_identifier=default_experiment_identifier,
         step_name=step_name,
@@ -105,5 +212,10 @@ def main():
         composite_image_paths=composite_image_paths,
         results_html=results_html
     )
+    if status == UPLOAD_FAILED:
+        logging.error("OpenBIS upload failed. Check the log above for details.")
+        return
+    if status == UPLOAD_SKIPPED:
+        logging.info("Identical data was already uploaded; nothing new was sent to OpenBIS.")
     logging.info("Pipeline completed successfully.")
 
@@ -1,6 +1,9 @@
 import os
 import sys
 import time
+import threading
+import collections
+from enum import IntEnum
 from datetime import datetime
 import logging
 from PyQt5.QtWidgets import (
@@ -9,7 +12,7 @@ from PyQt5.QtWidgets import (
     QMessageBox, QDialog, QPlainTextEdit, QComboBox, QTreeWidget, QTreeWidgetItem,
     QHBoxLayout,QSpinBox
 )
-from PyQt5.QtCore import QThread, QObject, pyqtSignal, Qt
+from PyQt5.QtCore import QThread, QObject, QRunnable, QThreadPool, QTimer, pyqtSignal, Qt
 
 # Import updated modules.
 from Metadataextractionnd2 import select_file, generate_metadata
@@ -19,31 +22,102 @@ from Adjustblackwhitepoints import adjust_black_white_cv2, save_black_white_poin
 from nd2to8bitpng import process_nd2_images_multithreaded
 from ImportOpenBIS import (
     authenticate_with_openbis, 
+    configure_openbis_session, 
     create_experimental_step_with_dataset, 
-    generate_results_html
+    generate_results_html,
+    UPLOAD_DONE,
+    UPLOAD_SKIPPED,
 )
 from pybis import Openbis
 
 logging.basicConfig(level=logging.INFO)
 
+# --- OpenBIS Lookup Cache ---
+# Spaces, projects and experiments rarely change during a session, so lookups are
+# cached for OPENBIS_CACHE_TTL seconds. The explorer's "Refresh" button clears it.
+OPENBIS_CACHE_TTL = 300
+_openbis_cache = {}
+_openbis_cache_lock = threading.Lock()
+
+def cached_openbis_call(key, fetch):
+    """Return the cached result for `key`, calling `fetch()` on a miss or after the TTL expires."""
+    now = time.monotonic()
+    with _openbis_cache_lock:
+        entry = _openbis_cache.get(key)
+    if entry is not None and now - entry[0] < OPENBIS_CACHE_TTL:
+        return entry[1]
+    value = fetch()
+    with _openbis_cache_lock:
+        _openbis_cache[key] = (now, value)
+    return value
+
+def clear_openbis_cache():
+    with _openbis_cache_lock:
+        _openbis_cache.clear()
+
+# --- Detached Threads ---
+# Threads still running when their dialog closes are parked here until they finish,
+# so closing a dialog neither blocks the GUI nor destroys a running QThread.
+_detached_threads = set()
+
+def detach_running_thread(thread):
+    """Keep `thread` alive until it finishes, then let Qt delete it."""
+    _detached_threads.add(thread)
+    thread.finished.connect(lambda: _detached_threads.discard(thread))
+    thread.finished.connect(thread.deleteLater)
+
 # --- Custom Qt Logging Handler ---
 class QtHandler(logging.Handler, QObject):
-    log_signal = pyqtSignal(str)
-    
-    def __init__(self):
+    """
+    Buffers formatted log records in a bounded queue; the GUI drains it on a timer
+    so heavy logging from worker threads does not trigger one widget update per record.
+    """
+    def __init__(self, maxlen=5000):
         logging.Handler.__init__(self)
         QObject.__init__(self)
+        self._log_queue = collections.deque(maxlen=maxlen)
     
     def emit(self, record):
-        msg = self.format(record)
-        self.log_signal.emit(msg)
+        self._log_queue.append(self.format(record))
+    
+    def drain(self, max_records=200):
+        """Pop up to `max_records` buffered messages, oldest first."""
+        batch = []
+        while self._log_queue and len(batch) < max_records:
+            batch.append(self._log_queue.popleft())
+        return batch
+
+# --- OpenBIS Children Loader ---
+class OpenBISChildrenLoader(QThread):
+    """
+    Runs one OpenBIS lookup (spaces, projects of a space, or experiments of a project)
+    off the GUI thread and emits (parent_item, children) when it completes,
+    or (parent_item, error message) if the lookup fails.
+    """
+    loaded = pyqtSignal(object, object)
+    failed = pyqtSignal(object, str)
+
+    def __init__(self, parent_item, fetch):
+        super().__init__()
+        self.parent_item = parent_item
+        self.fetch = fetch
+
+    def run(self):
+        try:
+            self.loaded.emit(self.parent_item, self.fetch())
+        except Exception as e:
+            self.failed.emit(self.parent_item, str(e))
 
 # --- OpenBIS Explorer Dialog ---
 class OpenBISExplorerDialog(QDialog):
     """
     Displays a collapsible tree of spaces → projects → experiments.
     Only spaces with a code matching your login (in uppercase) are shown.
+    Projects and experiments are fetched lazily when their parent is expanded.
     """
+    # Item data role flagging whether an item's children have been requested.
+    LOADED_ROLE = Qt.UserRole + 1
+
     def __init__(self, openbis_instance, parent=None):
         super().__init__(parent)
         self.setWindowTitle("OpenBIS Explorer")
@@ -53,55 +127,137 @@ class OpenBISExplorerDialog(QDialog):
         self.layout = QVBoxLayout(self)
         self.tree = QTreeWidget()
         self.tree.setHeaderLabel("OpenBIS Hierarchy")
+        self.tree.itemExpanded.connect(self.on_expand)
         self.layout.addWidget(self.tree)
         
         button_layout = QHBoxLayout()
         self.select_button = QPushButton("Select")
         self.select_button.clicked.connect(self.accept_selection)
-        self.cancel_buttonofcou = QPushButton("Cancel")
+        self.cancel_button = QPushButton("Cancel")
         self.cancel_button.clicked.connect(self.reject)
+        self.refresh_button = QPushButton("Refresh")
+        self.refresh_button.clicked.connect(self.refresh_tree)
+        button_layout.addWidget(self.refresh_button)
         button_layout.addWidget(self.select_button)
         button_layout.addWidget(self.cancel_button)
         self.layout.addLayout(button_layout)
         
+        self.loaders = []
         self.populate_tree()
     
+    def start_loader(self, parent_item, fetch):
+        loader = OpenBISChildrenLoader(parent_item, fetch)
+        loader.loaded.connect(self.add_children)
+        loader.failed.connect(self.load_failed)
+        loader.finished.connect(lambda: self.loader_finished(loader))
+        self.loaders.append(loader)
+        # Refreshing clears the tree, which would delete items that running loaders still report to.
+        self.refresh_button.setEnabled(False)
+        loader.start()
+
+    def loader_finished(self, loader):
+        if loader in self.loaders:
+            self.loaders.remove(loader)
+        if not self.loaders:
+            self.refresh_button.setEnabled(True)
+
+    def load_failed(self, parent_item, message):
+        logging.error(f"Failed to populate openBIS hierarchy: {message}")
+        if parent_item is None:
+            self.tree.addTopLevelItem(QTreeWidgetItem(["Failed to load spaces - press Refresh to retry"]))
+            return
+        # Allow the next expansion to fetch again, and replace the "Loading..." stub.
+        parent_item.setData(0, self.LOADED_ROLE, False)
+        parent_item.takeChildren()
+        parent_item.addChild(QTreeWidgetItem(["Failed to load - collapse and expand to retry"]))
+
     def populate_tree(self):
-        try:
-            all_spaces = self.openbis_instance.get_spaces()
-            login_name = (self.openbis_instance.username if hasattr(self.openbis_instance, "username") else "").upper()
-            filtered_spaces = [space for space in all_spaces if space.code.upper() == login_name]
+        # Only the spaces are fetched up front; deeper levels load on expansion.
+        token = getattr(self.openbis_instance, "token", None)
+        login_name = getattr(self.openbis_instance, "_login_name_upper", "")
+        logging.info(f"Login name: {login_name}")
 
-            logging.info(f"Login name: {login_name}")
+        def fetch_spaces():
+            all_spaces = cached_openbis_call((token, "spaces"), self.openbis_instance.get_spaces)
+            # Space codes are unique, so stop at the first match.
+            match = next((space for space in all_spaces if space.code.upper() == login_name), None)
+            filtered_spaces = [match] if match is not None else []
             logging.info(f"Filtered spaces: {[s.code for s in filtered_spaces]}")
+            return filtered_spaces
 
-            if not filtered_spaces:
-                logging.warning("No matching spaces found in openBIS.")
-                return
-            
-            # IMPORTANT: Iterate over filtered_spaces, NOT all_spaces
-            for space in filtered_spaces:
-                space_item = QTreeWidgetItem([space.code])
-                space_item.setData(0, Qt.UserRole, space)
-                self.tree.addTopLevelItem(space_item)
-                
-                projects = space.get_projects()
-                logging.info(f"  Found {len(projects)} projects in space {space.code}.")
-                for proj in projects:
-                    proj_item = QTreeWidgetItem([proj.code])
-                    proj_item.setData(0, Qt.UserRole, proj)
-                    space_item.addChild(proj_item)
-
-                    experiments = proj.get_experiments()
-                    logging.info(f"    Found {len(experiments)} experiments in project {proj.code}.")
-                    for exp in experiments:
-                        exp_item = QTreeWidgetItem([exp.code])
-                        exp_item.setData(0, Qt.UserRole, exp)
-                        proj_item.addChild(exp_item)
-
-            self.tree.expandAll()
-        except Exception as e:
-            logging.error(f"Failed to populate openBIS hierarchy: {e}")
+        self.start_loader(None, fetch_spaces)
+
+    def on_expand(self, item):
+        if item.data(0, self.LOADED_ROLE):
+            return
+        item.setData(0, self.LOADED_ROLE, True)
+        data = item.data(0, Qt.UserRole)
+        token = getattr(self.openbis_instance, "token", None)
+        parent = item.parent()
+        if parent is None:
+            key = (token, "projects", data.code)
+            fetch = lambda: cached_openbis_call(key, lambda: list(data.get_projects()))
+        else:
+            key = (token, "experiments", parent.text(0), data.code)
+            fetch = lambda: cached_openbis_call(key, lambda: list(data.get_experiments()))
+        self.start_loader(item, fetch)
+
+    def refresh_tree(self):
+        """Drop cached OpenBIS lookups and reload the hierarchy from the server."""
+        if self.loaders:
+            QMessageBox.information(self, "OpenBIS Explorer",
+                                    "Still loading from openBIS. Please try again once loading has finished.")
+            return
+        clear_openbis_cache()
+        self.tree.clear()
+        self.populate_tree()
+
+    def add_children(self, parent_item, children):
+        if parent_item is None and not children:
+            logging.warning("No matching spaces found in openBIS.")
+            return
+        # Experiments are leaves; spaces and projects get a stub child until expanded.
+        is_leaf = parent_item is not None and parent_item.parent() is not None
+        if parent_item is not None:
+            kind = "experiments" if is_leaf else "projects"
+            logging.info(f"  Found {len(children)} {kind} in {parent_item.text(0)}.")
+        # Build every item off-screen and insert the level in one call.
+        self.tree.setUpdatesEnabled(False)
+        self.tree.blockSignals(True)
+        try:
+            items = []
+            for child in children:
+                child_item = QTreeWidgetItem([child.code])
+                child_item.setData(0, Qt.UserRole, child)
+                if not is_leaf:
+                    child_item.addChild(QTreeWidgetItem(["Loading..."]))
+                items.append(child_item)
+            if parent_item is None:
+                self.tree.addTopLevelItems(items)
+            else:
+                parent_item.takeChildren()
+                parent_item.addChildren(items)
+        finally:
+            self.tree.blockSignals(False)
+            self.tree.setUpdatesEnabled(True)
+        if parent_item is None:
+            # Show each space's projects right away, as the eager tree did.
+            for item in items:
+                item.setExpanded(True)
+
+    def done(self, result):
+        # Never wait() on the GUI thread: abandon loaders still running and let them finish on their own.
+        for loader in self.loaders:
+            for signal in (loader.loaded, loader.failed, loader.finished):
+                try:
+                    signal.disconnect()
+                except TypeError:
+                    pass  # nothing connected
+            if loader.isRunning():
+                loader.requestInterruption()
+                detach_running_thread(loader)
+        self.loaders = []
+        super().done(result)
 
     def accept_selection(self):
         current_item = self.tree.currentItem()
@@ -121,6 +277,29 @@ class OpenBISExplorerDialog(QDialog):
     def get_selected_experiment_identifier(self):
         return self.selected_experiment_identifier
 
+# --- OpenBIS Login Worker ---
+class LoginWorker(QObject):
+    """Performs the blocking OpenBIS login on a background thread."""
+    finished = pyqtSignal(object, object)  # (openbis_instance, error)
+
+    def __init__(self, openbis_host, username, password):
+        super().__init__()
+        self.openbis_host = openbis_host
+        self.username = username
+        self.password = password
+
+    def do_login(self):
+        try:
+            openbis_instance = Openbis(self.openbis_host)
+            openbis_instance.login(self.username, self.password)
+            configure_openbis_session(openbis_instance)
+            # Save the username (and its uppercase form used to filter spaces) for later use
+            openbis_instance.username = self.username
+            openbis_instance._login_name_upper = self.username.upper()
+            self.finished.emit(openbis_instance, None)
+        except Exception as e:
+            self.finished.emit(None, e)
+
 # --- OpenBIS Login Dialog ---
 class OpenBISLoginDialog(QDialog):
     def __init__(self, openbis_host):
@@ -143,33 +322,112 @@ class OpenBISLoginDialog(QDialog):
         self.login_button.clicked.connect(self.accept_login)
         self.layout.addWidget(self.login_button)
         self.openbis_instance = None
+        self.login_thread = None
+        self.login_worker = None
 
     def accept_login(self):
+        username = self.username_input.text().strip()
+        password = self.password_input.text().strip()
+        if not username or not password:
+            QMessageBox.critical(self, "Login Failed", "Error: Both username and password must be provided.")
+            return
+        # Log in on a background thread so the dialog stays responsive.
+        self.login_button.setEnabled(False)
+        self.login_thread = QThread()
+        self.login_worker = LoginWorker(self.openbis_host, username, password)
+        self.login_worker.moveToThread(self.login_thread)
+        # The thread holds the worker so both outlive the dialog if it closes mid-login.
+        self.login_thread.worker = self.login_worker
+        self.login_thread.started.connect(self.login_worker.do_login)
+        self.login_worker.finished.connect(self.login_finished)
+        self.login_thread.finished.connect(self.login_worker.deleteLater)
+        self.login_thread.start()
+
+    def login_finished(self, openbis_instance, error):
+        # Never wait() here: this slot runs on the GUI thread.
+        self.login_thread.quit()
+        self.login_button.setEnabled(True)
+        if error is not None:
+            QMessageBox.critical(self, "Login Failed", f"Error: {error}")
+            return
+        self.openbis_instance = openbis_instance
+        QMessageBox.information(self, "Success", "Logged into OpenBIS successfully!")
+        self.accept()
+
+    def done(self, result):
+        # A login still in flight is abandoned rather than waited for.
+        if self.login_thread is not None and self.login_thread.isRunning():
+            try:
+                self.login_worker.finished.disconnect(self.login_finished)
+            except TypeError:
+                pass  # already disconnected
+            self.login_thread.quit()
+            detach_running_thread(self.login_thread)
+        super().done(result)
+
+# --- Pipeline Stages ---
+class Stage(IntEnum):
+    METADATA = 0
+    EXTRACT = 1
+    COMPOSITE = 2
+    ADJUST = 3
+    CONVERT = 4
+    OPENBIS = 5
+
+STAGE_LABELS = {
+    Stage.METADATA: "Generating metadata...",
+    Stage.EXTRACT: "Extracting images...",
+    Stage.COMPOSITE: "Creating composite images...",
+    Stage.ADJUST: "Adjusting black and white points...",
+    Stage.CONVERT: "Converting to 8-bit PNGs...",
+    Stage.OPENBIS: "Updating OpenBIS...",
+}
+
+# --- Pipeline Task ---
+class PipelineTask(QRunnable):
+    """
+    Runs one pipeline step on the global QThreadPool so it can overlap with the
+    steps running on the worker thread. Call wait() to get its result.
+    """
+    def __init__(self, fn, *args, **kwargs):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def run(self):
         try:
-            username = self.username_input.text().strip()
-            password = self.password_input.text().strip()
-            if not username or not password:
-                raise ValueError("Both username and password must be provided.")
-            self.openbis_instance = Openbis(self.openbis_host)
-            self.openbis_instance.login(username, password)
-            # Save the username in the instance for later use
-            self.openbis_instance.username = username
-            QMessageBox.information(self, "Success", "Logged into OpenBIS successfully!")
-            self.accept()
+            self.result = self.fn(*self.args, **self.kwargs)
         except Exception as e:
-            QMessageBox.critical(self, "Login Failed", f"Error: {e}")
+            self.error = e
+        finally:
+            self._done.set()
+
+    def start(self):
+        QThreadPool.globalInstance().start(self)
+        return self
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
 
 # --- Worker Thread ---
 class WorkerThread(QThread):
-    # Step indices: 0: Generate Metadata, 1: Extract Images, 2: Create Composite,
-    # 3: Adjust Black/White, 4: Convert to 8-bit PNGs, 5: Update OpenBIS
-    progress = pyqtSignal(str, int, int)
-    conversion_progress = pyqtSignal(str, int, int)
-    completion = pyqtSignal(int)
-    final_update_done = pyqtSignal(bool)
+    # stage_event(stage, current, total): total == 0 means the stage started,
+    # current == total means it completed, anything else is progress within it.
+    stage_event = pyqtSignal(int, int, int)
+    error = pyqtSignal(str)
+    final_update_done = pyqtSignal(str)  # UPLOAD_DONE, UPLOAD_SKIPPED or UPLOAD_FAILED
 
     def __init__(self, file_path, dimensions, channels, openbis_instance, output_dir,
-                 selected_project, date_str, user_str, setup_str, experiment_identifier, compression_level=0):
+                 selected_project, date_str, user_str, setup_str, experiment_identifier, compression_level=0,
+                 skip_existing=True):
         super().__init__()
         self.file_path = file_path
         self.dimensions = dimensions
@@ -182,10 +440,13 @@ class WorkerThread(QThread):
         self.setup_str = setup_str
         self.experiment_identifier = experiment_identifier
         self.compression_level = compression_level
-        self.stopped = False
+        self.skip_existing = skip_existing
+        # Keep references to pool tasks so they outlive run() if it returns early.
+        self.pending_tasks = []
 
     def stop(self):
-        self.stopped = True
+        # Cooperative cancellation: run() returns at the next step boundary.
+        self.requestInterruption()
 
     def run(self):
         try:
@@ -193,51 +454,72 @@ class WorkerThread(QThread):
             logging.info("Processing a {} sample.".format("2D" if is_2D else "3D"))
             
             # Step 0: Generate Metadata
-            self.progress.emit("Generating metadata...", 0, 0)
-            experimental_description, metadata_csv_path, tatexp_xml_path = generate_metadata(
-                self.file_path, self.dimensions, self.output_dir
-            )
-            self.completion.emit(0)
+            # Metadata does not feed steps 1-4, so it runs on the thread pool meanwhile.
+            self.stage_event.emit(Stage.METADATA, 0, 0)
+            metadata_task = PipelineTask(
+                generate_metadata, self.file_path, self.dimensions, self.output_dir
+            ).start()
+            self.pending_tasks.append(metadata_task)
             
             # Step 1: Extract Images
-            self.progress.emit("Extracting images...", 0, 1)
+            self.stage_event.emit(Stage.EXTRACT, 0, 0)
             extract_images_with_nd2_plugin(self.file_path, save_dir=self.output_dir)
-            self.completion.emit(1)
+            self.stage_event.emit(Stage.EXTRACT, 1, 1)
+            if self.isInterruptionRequested():
+                return
             
             # Step 2: Create Composite Images
-            self.progress.emit("Creating composite images...", 0, 2)
+            self.stage_event.emit(Stage.COMPOSITE, 0, 0)
             create_composite_images_for_all_channels(self.output_dir, num_channels=len(self.channels), channel_names=self.channels, dimensions=self.dimensions)
-            self.completion.emit(2)
+            self.stage_event.emit(Stage.COMPOSITE, 1, 1)
+            if self.isInterruptionRequested():
+                return
+            
+            experimental_description, metadata_csv_path, tatexp_xml_path = metadata_task.wait()
+            self.stage_event.emit(Stage.METADATA, 1, 1)
             
             # Step 3: Adjust Black/White Points
-            self.progress.emit("Adjusting black and white points...", 0, 3)
+            self.stage_event.emit(Stage.ADJUST, 0, 0)
             bw_points = adjust_black_white_cv2(self.output_dir)
             save_black_white_points(bw_points, os.path.join(self.output_dir, "black_white_points.json"))
-            self.completion.emit(3)
+            self.stage_event.emit(Stage.ADJUST, 1, 1)
+            if self.isInterruptionRequested():
+                return
             
             # Step 4: Convert to 8-bit PNGs
-            self.progress.emit("Converting to 8-bit PNGs...", 0, 4)
+            self.stage_event.emit(Stage.CONVERT, 0, 0)
+            # Throttle progress signals so thousands of frames do not flood the GUI event loop.
+            last_emit = [0.0]
+            convert_total = [1]
             def my_progress_callback(msg, current, total):
-                self.conversion_progress.emit(msg, current, total)
+                convert_total[0] = max(total, 1)
+                now = time.monotonic()
+                if now - last_emit[0] > 0.05 or current == total:
+                    self.stage_event.emit(Stage.CONVERT, current, total)
+                    last_emit[0] = now
             conversion_results = process_nd2_images_multithreaded(
                 self.file_path,
                 self.output_dir,
                 os.path.join(self.output_dir, "black_white_points.json"),
                 datetime.now().strftime("%y%m%d"),
                 "AK",  # Adjust as needed, or replace with your username if appropriate.
-                compression_percent=self.compression_level,  # Note: here compression_percent is used, so adjust your conversion code accordingly.
+                compress_level=self.compression_level,
                 progress_callback=my_progress_callback
             )
-            self.completion.emit(4)
+            self.stage_event.emit(Stage.CONVERT, convert_total[0], convert_total[0])
+            if self.isInterruptionRequested():
+                return
             
             # Step 5: Update OpenBIS
-            self.progress.emit("Updating OpenBIS...", 0, 5)
-            json_path = os.path.join(self.output_dir, "black_white_points.json")
+            # Only started once the conversion has finished and no stop was requested,
+            # so stopping the pipeline before this point never creates an experimental step.
+            self.stage_event.emit(Stage.OPENBIS, 0, 0)
             main_folder_name = self.output_dir
             step_name = os.path.basename(self.file_path).replace('.nd2', '')
-            composite_image_paths = [os.path.join(self.output_dir, f"{name}.png") for name in self.channels]
-            results_html = generate_results_html(json_path, composite_image_paths, main_folder_name)
-            create_experimental_step_with_dataset(
+            out_prefix = os.fspath(self.output_dir) + os.sep
+            composite_image_paths = [out_prefix + name + ".tif" for name in self.channels]
+            results_html = generate_results_html(bw_points, composite_image_paths, main_folder_name)
+            upload_status = create_experimental_step_with_dataset(
                 openbis_instance=self.openbis_instance,
                 experiment_identifier=self.experiment_identifier,
                 step_name=step_name,
@@ -245,11 +527,11 @@ class WorkerThread(QThread):
                 metadata_csv_path=metadata_csv_path,
                 composite_image_paths=composite_image_paths,
                 results_html=results_html,
+                skip_existing=self.skip_existing,
             )
-            self.final_update_done.emit(True)
-            self.completion.emit(5)
+            self.final_update_done.emit(upload_status)
         except Exception as e:
-            self.progress.emit(f"Error: {e}", 0, -1)
+            self.error.emit(str(e))
 
 # --- Main Application Window ---
 class ND2PipelineApp(QMainWindow):
@@ -258,6 +540,7 @@ class ND2PipelineApp(QMainWindow):
         self.setWindowTitle("ND2 Pipeline Interface")
         self.openbis_instance = openbis_instance
         self.file_path = None
+        self._file_base = None
         self.dimensions = None
         self.channels = []
         self.output_dir = None
@@ -314,8 +597,11 @@ class ND2PipelineApp(QMainWindow):
         self.stop_btn = QPushButton("Stop")
         self.stop_btn.setEnabled(False)
         self.stop_btn.clicked.connect(self.stop_pipeline)
+        # Uploads identical to the last one from this output folder are skipped unless forced.
+        self.force_upload_checkbox = QCheckBox("Force re-upload to OpenBIS")
         control_layout.addWidget(self.start_btn)
         control_layout.addWidget(self.stop_btn)
+        control_layout.addWidget(self.force_upload_checkbox)
         self.layout.addLayout(control_layout)
         
         self.step_checkboxes = []
@@ -353,33 +639,41 @@ class ND2PipelineApp(QMainWindow):
         # Create a QSpinBox that accepts values 0 to 9.
         self.compression_spinbox = QSpinBox()
         self.compression_spinbox.setRange(0, 9)
-        self.compression_spinbox.setValue(0)  # Default 0 means no compression.
+        self.compression_spinbox.setValue(1)  # Default 1: fastest compression, only slightly larger files.
         compression_layout.addWidget(self.compression_spinbox)
 
         # Create a "?" QLabel with a tooltip.
         question_label = QLabel("?")
-        question_label.setToolTip("PNG Compression Level:\n0 = No compression (largest file)\n9 = Maximum compression (smallest file)")
+        question_label.setToolTip("PNG Compression Level:\n0 = No compression (largest file)\n1 = Fastest (recommended)\n9 = Maximum compression (smallest file, slowest)")
         compression_layout.addWidget(question_label)
 
         # Add this compression layout to your main layout.
         self.layout.addLayout(compression_layout)
 
     def setup_logging(self):
-        qt_handler = QtHandler()
-        qt_handler.setLevel(logging.INFO)
+        # Keep the log view bounded so long runs do not grow it without limit.
+        self.log_widget.setMaximumBlockCount(2000)
+        self.qt_handler = QtHandler()
+        self.qt_handler.setLevel(logging.INFO)
         formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-        qt_handler.setFormatter(formatter)
-        qt_handler.log_signal.connect(self.append_log)
-        logging.getLogger().addHandler(qt_handler)
+        self.qt_handler.setFormatter(formatter)
+        logging.getLogger().addHandler(self.qt_handler)
+        # Append buffered records in batches every 100 ms.
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self.append_log)
+        self.log_timer.start(100)
     
-    def append_log(self, msg):
-        self.log_widget.appendPlainText(msg)
+    def append_log(self):
+        batch = self.qt_handler.drain()
+        if batch:
+            self.log_widget.appendPlainText("\n".join(batch))
     
     def populate_projects(self):
         try:
-            all_projects = self.openbis_instance.get_projects()
+            token = getattr(self.openbis_instance, "token", None)
+            all_projects = cached_openbis_call((token, "all_projects"), self.openbis_instance.get_projects)
             # Retrieve the username from the openBIS instance and convert it to uppercase.
-            login_name = (self.openbis_instance.username if hasattr(self.openbis_instance, "username") else "").upper()
+            login_name = getattr(self.openbis_instance, "_login_name_upper", "")
             logging.info(f"Using login name: {login_name}")
             # Filter projects where the space code matches the login name.
             filtered_projects = [p for p in all_projects if p.space.code.upper() == login_name]
@@ -403,6 +697,15 @@ class ND2PipelineApp(QMainWindow):
             else:
                 QMessageBox.warning(self, "Warning", "No experiment selected.")
     
+    @staticmethod
+    def _clear_layout(layout):
+        """Remove every item from a layout and schedule its widgets for deletion."""
+        while (item := layout.takeAt(0)) is not None:
+            widget = item.widget()
+            if widget is not None:
+                widget.deleteLater()
+        layout.invalidate()
+
     def select_file(self):
         try:
             self.file_path, self.dimensions, self.output_dir = select_file()
@@ -410,23 +713,22 @@ class ND2PipelineApp(QMainWindow):
             self.dimension_label.setText(f"Dimensions: {self.dimensions}")
             num_channels = self.dimensions.get("C", 1)
             self.channels = [f"Channel {i+1}" for i in range(num_channels)]
-            for i in range(self.channel_layout.count()):
-                self.channel_layout.itemAt(i).widget().deleteLater()
-            self.channel_entries.clear()
-            for i, channel in enumerate(self.channels):
-                label = QLabel(f"Channel {i+1}:")
-                entry = QLineEdit()
-                entry.setText(channel)
-                self.channel_layout.addWidget(label, i, 0)
-                self.channel_layout.addWidget(entry, i, 1)
-                self.channel_entries.append(entry)
-            file_base = os.path.splitext(os.path.basename(self.file_path))[0]
-            date_str = file_base[:6]
-            user_str = file_base[6:8]
-            setup_str = file_base[8:10]
-            self.date_edit.setText(date_str)
-            self.user_edit.setText(user_str)
-            self.setup_edit.setText(setup_str)
+            self._clear_layout(self.channel_layout)
+            # Build all rows first, then add them with repaints suspended.
+            labels = [QLabel(f"Channel {i+1}:") for i in range(num_channels)]
+            self.channel_entries = [QLineEdit(channel) for channel in self.channels]
+            self.central_widget.setUpdatesEnabled(False)
+            try:
+                for i, (label, entry) in enumerate(zip(labels, self.channel_entries)):
+                    self.channel_layout.addWidget(label, i, 0)
+                    self.channel_layout.addWidget(entry, i, 1)
+            finally:
+                self.central_widget.setUpdatesEnabled(True)
+            # Parse the file name once; start_pipeline reuses it.
+            self._file_base = os.path.splitext(os.path.basename(self.file_path))[0]
+            self.date_edit.setText(self._file_base[:6])
+            self.user_edit.setText(self._file_base[6:8])
+            self.setup_edit.setText(self._file_base[8:10])
             self.start_btn.setEnabled(True)
         except Exception as e:
             self.file_label.setText(f"Error selecting file: {e}")
@@ -442,8 +744,7 @@ class ND2PipelineApp(QMainWindow):
         selected_project = self.project_combo.currentText()
 
         if self.selected_experiment_identifier is None:
-            file_base = os.path.splitext(os.path.basename(self.file_path))[0]
-            experiment_identifier = f"{selected_project}/{file_base}"
+            experiment_identifier = f"{selected_project}/{self._file_base}"
         else:
             experiment_identifier = self.selected_experiment_identifier
 
@@ -466,38 +767,56 @@ class ND2PipelineApp(QMainWindow):
             user_str,
             setup_str,
             experiment_identifier,
-            compression_level  # Pass the compression level (0-9)
+            compression_level,  # Pass the compression level (0-9)
+            skip_existing=not self.force_upload_checkbox.isChecked(),
         )
-        self.worker.progress.connect(self.update_progress)
-        self.worker.completion.connect(self.mark_step_completed)
-        self.worker.conversion_progress.connect(self.update_conversion_progress)
+        self.worker.stage_event.connect(self.on_stage_event)
+        self.worker.error.connect(self.show_error)
         self.worker.final_update_done.connect(self.final_update_complete)
+        self.worker.finished.connect(self.worker_finished)
         self.worker.start()
         self.stop_btn.setEnabled(True)
     
     def stop_pipeline(self):
         if hasattr(self, "worker") and self.worker.isRunning():
+            # Do not block the GUI; worker_finished updates the UI once the worker returns.
             self.worker.stop()
-            self.worker.wait()
             self.stop_btn.setEnabled(False)
+            self.progress_label.setText("Stopping after the current step...")
+    
+    def worker_finished(self):
+        if self.worker.isInterruptionRequested():
             self.progress_label.setText("Pipeline stopped by user.")
             self.progress_bar.setValue(0)
+        self.stop_btn.setEnabled(False)
     
-    def final_update_complete(self, success):
-        if success:
+    def final_update_complete(self, status):
+        if status == UPLOAD_DONE:
             self.progress_label.setText("OpenBIS update completed successfully!")
-            self.mark_step_completed(5)
+            self.mark_step_completed(Stage.OPENBIS)
+        elif status == UPLOAD_SKIPPED:
+            self.progress_label.setText("OpenBIS upload skipped: identical data was already uploaded. "
+                                        "Tick \"Force re-upload\" to upload it again.")
+            self.mark_step_completed(Stage.OPENBIS)
         else:
             self.progress_label.setText("OpenBIS update failed. Check logs.")
         self.stop_btn.setEnabled(False)
     
-    def update_progress(self, message, progress, step_index):
-        self.progress_label.setText(f"Progress: {message}")
+    def on_stage_event(self, stage, current, total):
+        if total == 0:
+            self.progress_label.setText(f"Progress: {STAGE_LABELS[stage]}")
+            return
+        if stage == Stage.CONVERT:
+            if current >= total:
+                self.progress_label.setText(f"Converted {total} images to 8-bit PNGs.")
+            else:
+                self.progress_label.setText(f"Converting image {current} of {total}")
+            self.progress_bar.setValue(int(100 * current / max(total, 1)))
+        if current >= total:
+            self.mark_step_completed(stage)
     
-    def update_conversion_progress(self, message, current, total):
-        self.progress_label.setText(message)
-        progress_percentage = int((current / total) * 100)
-        self.progress_bar.setValue(progress_percentage)
+    def show_error(self, message):
+        self.progress_label.setText(f"Progress: Error: {message}")
     
     def mark_step_completed(self, step_index):
         if 0 <= step_index < len(self.step_checkboxes):
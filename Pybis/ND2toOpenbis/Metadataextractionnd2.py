@@ -1,10 +1,16 @@
 import json
 import nd2
 import os
-import pandas as pd
+import csv
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # The Feather sidecar is optional.
+    pa = None
 import logging
-from tkinter import Tk
-from tkinter.filedialog import askopenfilename
+import functools
+import re
+from collections import deque
 from nd2 import ND2File
 from TATexp import create_tatexp_xml
 
@@ -12,12 +18,9 @@ logging.basicConfig(level=logging.INFO)
 
 def select_file():
     """Let the user select a file and return its path, dimensions, and a dedicated output directory."""
+    # Tk is only imported here, so headless and worker-process imports of this module stay light.
     from tkinter import Tk
     from tkinter.filedialog import askopenfilename
-    import os
-    import nd2
-    from nd2 import ND2File
-    import logging
 
     Tk().withdraw()  # Hide the root window
     file_path = askopenfilename(
@@ -28,13 +31,19 @@ def select_file():
         logging.error("No file selected. Exiting.")
         exit()
     try:
-        with ND2File(file_path) as nd2_data:
-            dimensions = nd2_data.sizes
-            logging.info(f"ND2 Dimensions: {dimensions}")
+        # Reads the metadata in the same open, so generate_metadata later hits the cache
+        # instead of opening the file a second time.
+        dimensions, _, _ = load_nd2_info(file_path)
+        logging.info(f"ND2 Dimensions: {dimensions}")
     except Exception as e:
         logging.error(f"Error opening ND2 file: {e}")
         exit()
     
+    output_dir = prepare_output_dir(file_path)
+    return file_path, dimensions, output_dir
+
+def prepare_output_dir(file_path):
+    """Create and return the dedicated output directory <file_base>_analysis/<prefix> next to the ND2 file."""
     # Get the base directory of the file and its base name
     base_dir = os.path.dirname(file_path)
     file_base = os.path.splitext(os.path.basename(file_path))[0]  # e.g. "250307AK35_WNTbiosensors_esc001"
@@ -52,70 +61,133 @@ def select_file():
     
     logging.info(f"Output directory created: {output_dir}")
     
-    return file_path, dimensions, output_dir
+    return output_dir
 
 def flatten_metadata(metadata, parent_key='', sep='|'):
     """Flattens a nested dictionary into a single-level dictionary."""
-    items = []
-    for k, v in metadata.items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else k
-        if isinstance(v, dict):
-            items.extend(flatten_metadata(v, new_key, sep=sep).items())
+    flat = {}
+    # Iterative depth-first walk; keeping an item iterator per level preserves the original key order.
+    stack = deque([(parent_key, iter(metadata.items()))])
+    while stack:
+        prefix, items = stack[-1]
+        for k, v in items:
+            new_key = f"{prefix}{sep}{k}" if prefix else k
+            if isinstance(v, dict):
+                stack.append((new_key, iter(v.items())))
+                break
+            flat[new_key] = v
         else:
-            items.append((new_key, v))
-    return dict(items)
+            stack.pop()
+    return flat
+
+@functools.lru_cache(maxsize=8)
+def _load_nd2_info(file_path, mtime):
+    """Open the ND2 file once and return (sizes, shape, flattened unstructured metadata).
+
+    Cached per (path, mtime); callers must treat the returned dicts as read-only.
+    """
+    with ND2File(file_path) as nd2_file:
+        return nd2_file.sizes, nd2_file.shape, flatten_metadata(nd2_file.unstructured_metadata())
+
+def load_nd2_info(file_path):
+    """Return (sizes, shape, flattened metadata) for an ND2 file, opening it only once per modification."""
+    return _load_nd2_info(file_path, os.path.getmtime(file_path))
+
+def load_flat_metadata(file_path):
+    """Return (shape, flattened metadata) for an ND2 file, parsing it only once per modification."""
+    _, shape, flattened_metadata = load_nd2_info(file_path)
+    return shape, flattened_metadata
+
+def write_metadata_csv(flattened_metadata, output_csv_path):
+    """Write flattened metadata as a two-column Key,Value CSV in a single pass."""
+    with open(output_csv_path, 'w', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(("Key", "Value"))
+        writer.writerows(flattened_metadata.items())
+
+def write_metadata_feather(flattened_metadata, output_path):
+    """Write flattened metadata as a zstd-compressed Feather table with string Key/Value columns."""
+    # Values mix numbers, strings and lists, so store them as text like the CSV does.
+    table = pa.table({
+        "Key": list(flattened_metadata),
+        "Value": ["" if v is None else str(v) for v in flattened_metadata.values()],
+    })
+    feather.write_feather(table, output_path, compression="zstd")
+
+def save_metadata(flattened_metadata, output_csv_path):
+    """
+    Write the metadata CSV (uploaded to openBIS and read by people) and, when pyarrow is
+    installed, a Feather sidecar next to it for faster loading by downstream tools.
+    """
+    write_metadata_csv(flattened_metadata, output_csv_path)
+    if pa is not None:
+        write_metadata_feather(flattened_metadata, os.path.splitext(output_csv_path)[0] + ".feather")
+
+# One pass over the laser text block. Alternatives are tried in the same order as the old
+# line-by-line checks; each value is the text between the first and second colon of its line.
+LASER_LINE_RE = re.compile(r"""
+    ^[ \t]*(?:
+        Scanner[^:\r\n]*:(?P<scanner>[^:\r\n]*)
+      | Detector[^:\r\n]*:(?P<detector>[^:\r\n]*)
+      | Gain[^:\r\n]*:(?P<gain>[^:\r\n]*)
+      | Line\ Averaging[^:\r\n]*:(?P<line_averaging>[^:\r\n]*)
+      | Emission\ Range[^:\r\n]*:(?P<emission_range>[^:\r\n]*)
+      | (?P<laser>Laser(?=[^\r\n]*nm)[^:\r\n]*)
+      | (?=[^\r\n]*Power:)[^:\r\n]*:(?P<power>[^:\r\n]*)
+      | Zoom:(?P<zoom>[^:\r\n]*)
+    )""", re.MULTILINE | re.VERBOSE)
+
+LASER_DEFAULTS = {
+    "detector": "Unknown",
+    "scanner": "Unknown",
+    "gain": "Unknown",
+    "power": "Unknown",
+    "emission_range": "Unknown",
+    "line_averaging": "N/A",
+}
 
 def parse_laser_metadata(laser_info_raw):
     """Parse the laser configuration info and return a list of laser settings rows."""
     laser_rows = []
     current_laser = None
-    detector = "Unknown"
-    scanner = "Unknown"
-    gain = "Unknown"
-    power = "Unknown"
-    emission_range = "Unknown"
-    line_averaging = "N/A"
-    current_zoom = "Unknown"
+    settings = dict(LASER_DEFAULTS)
     
-    for line in laser_info_raw.splitlines():
-        line = line.strip()
-        if line.startswith("Scanner"):
-            scanner = line.split(":")[1].strip()
-        elif line.startswith("Detector"):
-            detector = line.split(":")[1].strip()
-        elif line.startswith("Gain"):
-            gain = line.split(":")[1].strip()
-        elif line.startswith("Line Averaging"):
-            line_averaging = line.split(":")[1].strip()
-        elif line.startswith("Emission Range"):
-            emission_range = line.split(":")[1].strip()
-        elif line.startswith("Laser") and "nm" in line:
-            current_laser = line.split(":")[0].strip()  # e.g., "Laser 488 nm"
-        elif current_laser and "Power:" in line:
-            power = line.split(":")[1].strip()
-        elif line.startswith("Zoom:"):
-            current_zoom = line.split(":")[1].strip()
+    for match in LASER_LINE_RE.finditer(laser_info_raw):
+        field = match.lastgroup
+        value = match.group(field).strip()
+        if field == "laser":
+            current_laser = value  # e.g., "Laser 488 nm"
+        elif field == "power":
+            if current_laser:
+                settings["power"] = value
+        elif field == "zoom":
             if current_laser:
                 laser_rows.append([
                     current_laser,
-                    detector,
-                    scanner,
-                    emission_range,
-                    gain,
-                    power,
-                    current_zoom,
-                    line_averaging
+                    settings["detector"],
+                    settings["scanner"],
+                    settings["emission_range"],
+                    settings["gain"],
+                    settings["power"],
+                    value,
+                    settings["line_averaging"]
                 ])
                 current_laser = None
-                detector = "Unknown"
-                scanner = "Unknown"
-                gain = "Unknown"
-                power = "Unknown"
-                current_zoom = "Unknown"
-                emission_range = "Unknown"
-                line_averaging = "N/A"
+                settings = dict(LASER_DEFAULTS)
+        else:
+            settings[field] = value
     return laser_rows
 
+def create_html_table(rows, headers):
+    """Render rows as an HTML table with a header row, building the markup in a single join."""
+    parts = ["<table border='1'><tr>", *(f"<th>{header}</th>" for header in headers), "</tr>"]
+    for row in rows:
+        parts.append("<tr>")
+        parts.extend(f"<td>{cell}</td>" for cell in row)
+        parts.append("</tr>")
+    parts.append("</table>")
+    return "".join(parts)
+
 def extract_nd2_metadata():
     """
     Extract metadata from an ND2 file, save it as CSV, and generate an experimental description in HTML.
@@ -125,6 +197,15 @@ def extract_nd2_metadata():
     if not file_path:
         logging.error("No valid file selected.")
         return None, None, None, None
+    return extract_nd2_metadata_from_path(file_path, output_dir)
+
+def extract_nd2_metadata_from_path(file_path, output_dir=None):
+    """
+    Same as extract_nd2_metadata, but for a known file path without the file dialog.
+    The output folder defaults to the one select_file would create.
+    """
+    if output_dir is None:
+        output_dir = prepare_output_dir(file_path)
     
     # Generate the metadata CSV file path
     output_csv_path = os.path.join(output_dir, os.path.basename(file_path).replace('.nd2', '_metadata.csv'))
@@ -133,26 +214,18 @@ def extract_nd2_metadata():
     laser_power_rows = []  # For laser configuration details
     
     try:
-        with ND2File(file_path) as nd2_file:
-            file_info_rows.append(["File Dimensions", str(nd2_file.shape)])
-            logging.info(f"File Dimensions: {nd2_file.shape}")
-            
-            # Retrieve unstructured metadata and log it
-            all_metadata = nd2_file.unstructured_metadata()
-            logging.info(f"Unstructured metadata: {all_metadata}")
-            
-            flattened_metadata = flatten_metadata(all_metadata)
-            logging.info(f"Flattened metadata: {flattened_metadata}")
-            
-            metadata_df = pd.DataFrame(list(flattened_metadata.items()), columns=["Key", "Value"])
-            
-            logging.info(f"Attempting to write metadata CSV to: {output_csv_path}")
-            metadata_df.to_csv(output_csv_path, index=False)
-            if os.path.exists(output_csv_path):
-                logging.info(f"Metadata table saved as '{output_csv_path}'.")
-            else:
-                logging.error(f"Failed to create metadata CSV at '{output_csv_path}'.")
-            
+        shape, flattened_metadata = load_flat_metadata(file_path)
+        file_info_rows.append(["File Dimensions", str(shape)])
+        logging.info(f"File Dimensions: {shape}")
+        logging.info(f"Flattened metadata: {flattened_metadata}")
+        
+        logging.info(f"Attempting to write metadata CSV to: {output_csv_path}")
+        save_metadata(flattened_metadata, output_csv_path)
+        if os.path.exists(output_csv_path):
+            logging.info(f"Metadata table saved as '{output_csv_path}'.")
+        else:
+            logging.error(f"Failed to create metadata CSV at '{output_csv_path}'.")
+        
         resolution_width = flattened_metadata.get('ImageAttributesLV|SLxImageAttributes|uiWidth', "Unknown")
         resolution_height = flattened_metadata.get('ImageAttributesLV|SLxImageAttributes|uiHeight', "Unknown")
         file_info_rows.append(["Resolution", f"{resolution_width}x{resolution_height}"])
@@ -175,14 +248,6 @@ def extract_nd2_metadata():
         logging.error(f"Error during metadata extraction: {e}")
         return None, None, None, None
     
-    def create_html_table(rows, headers):
-        html = "<table border='1'>"
-        html += "<tr>" + "".join(f"<th>{header}</th>" for header in headers) + "</tr>"
-        for row in rows:
-            html += "<tr>" + "".join(f"<td>{cell}</td>" for cell in row) + "</tr>"
-        html += "</table>"
-        return html
-    
     general_metadata_table = create_html_table(file_info_rows, ["Key", "Value"])
     laser_table_headers = ["Laser Wavelength", "Detector", "Scanner", "Emission Range", "Gain", "Laser Power", "Zoom", "Line Averaging"]
     laser_power_table = create_html_table(laser_power_rows, laser_table_headers)
@@ -196,26 +261,21 @@ def generate_metadata(file_path, dimensions, output_dir):
     Generate metadata from the given ND2 file and save it as a CSV in the output directory.
     Returns a tuple: (experimental_description, metadata_csv_path)
     """
-    from nd2 import ND2File  # ensure you import here if needed
-    import pandas as pd
     output_csv_path = os.path.join(output_dir, os.path.basename(file_path).replace('.nd2', '_metadata.csv'))
     
     file_info_rows = []
     laser_power_rows = []
     
     try:
-        with ND2File(file_path) as nd2_file:
-            file_info_rows.append(["File Dimensions", str(nd2_file.shape)])
-            all_metadata = nd2_file.unstructured_metadata()
-            flattened_metadata = flatten_metadata(all_metadata)
-            metadata_df = pd.DataFrame(list(flattened_metadata.items()), columns=["Key", "Value"])
-            metadata_df.to_csv(output_csv_path, index=False)
-            # Log that the CSV was written
-            if os.path.exists(output_csv_path):
-                print(f"Metadata CSV saved as '{output_csv_path}'.")
-            else:
-                print(f"Failed to create metadata CSV at '{output_csv_path}'.")
-                
+        shape, flattened_metadata = load_flat_metadata(file_path)
+        file_info_rows.append(["File Dimensions", str(shape)])
+        save_metadata(flattened_metadata, output_csv_path)
+        # Log that the CSV was written
+        if os.path.exists(output_csv_path):
+            print(f"Metadata CSV saved as '{output_csv_path}'.")
+        else:
+            print(f"Failed to create metadata CSV at '{output_csv_path}'.")
+            
         resolution_width = flattened_metadata.get('ImageAttributesLV|SLxImageAttributes|uiWidth', "Unknown")
         resolution_height = flattened_metadata.get('ImageAttributesLV|SLxImageAttributes|uiHeight', "Unknown")
         file_info_rows.append(["Resolution", f"{resolution_width}x{resolution_height}"])
@@ -250,14 +310,6 @@ def generate_metadata(file_path, dimensions, output_dir):
 
 
     # Build an HTML description from the metadata
-    def create_html_table(rows, headers):
-        html = "<table border='1'>"
-        html += "<tr>" + "".join(f"<th>{header}</th>" for header in headers) + "</tr>"
-        for row in rows:
-            html += "<tr>" + "".join(f"<td>{cell}</td>" for cell in row) + "</tr>"
-        html += "</table>"
-        return html
-
     general_metadata_table = create_html_table(file_info_rows, ["Key", "Value"])
     laser_table_headers = ["Laser Wavelength", "Detector", "Scanner", "Emission Range", "Gain", "Laser Power", "Zoom", "Line Averaging"]
     laser_power_table = create_html_table(laser_power_rows, laser_table_headers)
@@ -1,13 +1,35 @@
 import os
 import numpy as np
 import math
-from tifffile import imwrite
-from skimage.io import imread
+from tifffile import imwrite, imread
+from tifffile import memmap as tiff_memmap
 from PIL import Image, ImageDraw, ImageFont
 import logging
+import re
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 logging.basicConfig(level=logging.INFO)
 
+# Extracted TIFFs are named channel_<idx>_time_<t>_z_<z>.tiff
+CHANNEL_FILE_RE = re.compile(r"channel_(\d+)_")
+
+def index_channel_files(position_dirs):
+    """Scan each position directory once and bucket its files by channel index (sorted per channel)."""
+    files_by_position = {}
+    for pos_dir in position_dirs:
+        by_channel = defaultdict(list)
+        with os.scandir(pos_dir) as entries:
+            for entry in entries:
+                match = CHANNEL_FILE_RE.match(entry.name)
+                if match:
+                    by_channel[int(match.group(1))].append(entry.path)
+        for files in by_channel.values():
+            files.sort()
+        files_by_position[pos_dir] = by_channel
+    return files_by_position
+
 def create_composite_images_for_all_channels(output_dir, num_channels, channel_names=None, dimensions=None, max_positions_per_row=10):
     """
     Creates labeled composite images for all channels.
@@ -26,73 +48,94 @@ def create_composite_images_for_all_channels(output_dir, num_channels, channel_n
         channel_names = [f"Channel {i+1}" for i in range(num_channels)]
     
     # Get the list of position directories in the output folder.
-    position_dirs = sorted([os.path.join(output_dir, d) for d in os.listdir(output_dir)
-                              if os.path.isdir(os.path.join(output_dir, d))])
+    with os.scandir(output_dir) as entries:
+        position_dirs = sorted(e.path for e in entries if e.is_dir())
     if not position_dirs:
         logging.error("No position directories found in the specified output_dir.")
         return
 
     logging.info(f"Found {len(position_dirs)} position directories.")
+    files_by_position = index_channel_files(position_dirs)
     
-    # For each channel, build a composite from the first image (e.g. time point 0) in each position.
-    for channel_idx, channel_name in enumerate(channel_names):
-        logging.info(f"Creating composite image for {channel_name}")
-        position_images = []  # This will hold one image per position for the given channel.
-        for pos_dir in position_dirs:
-            # Assume filenames contain "channel_{channel_idx}" and a time indicator.
-            # We'll filter for files that match and pick the first one.
-            files = sorted([os.path.join(pos_dir, f) for f in os.listdir(pos_dir)
-                            if f"channel_{channel_idx}" in f])
-            logging.info(f"  {pos_dir}: found {len(files)} files for channel {channel_idx}")
-            if not files:
-                logging.warning(f"  No files for channel {channel_idx} in {pos_dir}")
-                continue
-            # Use the first file as the representative image.
+    # Each channel's composite is independent, so channels are built in parallel processes.
+    max_workers = min(len(channel_names), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(create_composite_image_for_channel, output_dir,
+                            [(pos_dir, by_channel.get(channel_idx, [])) for pos_dir, by_channel in files_by_position.items()],
+                            channel_idx, channel_name, dimensions, max_positions_per_row)
+            for channel_idx, channel_name in enumerate(channel_names)
+        ]
+        for future in futures:
+            future.result()
+
+def create_composite_image_for_channel(output_dir, position_files, channel_idx, channel_name, dimensions=None, max_positions_per_row=10):
+    """
+    Builds the composite for one channel from the first image (e.g. time point 0) in each position
+    and saves it as <channel_name>.tif in output_dir.
+    position_files is a list of (position_dir, sorted files for this channel) pairs.
+    """
+    logging.info(f"Creating composite image for {channel_name}")
+    position_images = []  # This will hold one image per position for the given channel.
+    for pos_dir, files in position_files:
+        logging.info(f"  {pos_dir}: found {len(files)} files for channel {channel_idx}")
+        if not files:
+            logging.warning(f"  No files for channel {channel_idx} in {pos_dir}")
+            continue
+        # Use the first file as the representative image.
+        try:
             try:
+                # Map the file instead of decoding it, so only the plane we use is read from disk.
+                img = tiff_memmap(files[0], mode="r")
+            except ValueError:
+                # Compressed or non-contiguous TIFFs cannot be memory-mapped.
                 img = imread(files[0])
-                # If the image is 3D and dimensions indicate 3D, extract the middle plane
-                if img.ndim == 3 and dimensions and dimensions.get("Z", 1) > 1:
-                    z_index = dimensions["Z"] // 2
-                    img = img[z_index]
-                position_images.append(img)
-            except Exception as e:
-                logging.error(f"  Failed to read image {files[0]}: {e}")
-        
-        if not position_images:
-            logging.warning(f"No valid images found for channel {channel_idx}. Skipping composite creation for this channel.")
-            continue
-        
-        # Arrange position_images in a grid.
-        n_positions = len(position_images)
-        n_cols = min(max_positions_per_row, n_positions)
-        n_rows = math.ceil(n_positions / max_positions_per_row)
-        logging.info(f"Arranging {n_positions} positions in {n_rows} rows and {n_cols} columns.")
-        
-        # Use the shape of the first image as reference.
-        sample_image = position_images[0]
-        cell_height, cell_width = sample_image.shape[:2]
-        composite_height = n_rows * cell_height
-        composite_width = n_cols * cell_width
-        # Create a blank composite image (assuming grayscale 16-bit images).
-        composite_image = np.zeros((composite_height, composite_width), dtype=np.uint16)
-        
-        # Place each image into the composite grid.
+            # If the image is 3D and dimensions indicate 3D, extract the middle plane
+            if img.ndim == 3 and dimensions and dimensions.get("Z", 1) > 1:
+                z_index = dimensions["Z"] // 2
+                img = img[z_index]
+            # Keep the mapped plane; its pixels are only read when copied into the composite.
+            position_images.append(img)
+        except Exception as e:
+            logging.error(f"  Failed to read image {files[0]}: {e}")
+    
+    if not position_images:
+        logging.warning(f"No valid images found for channel {channel_idx}. Skipping composite creation for this channel.")
+        return
+    
+    # Arrange position_images in a grid.
+    n_positions = len(position_images)
+    n_cols = min(max_positions_per_row, n_positions)
+    n_rows = math.ceil(n_positions / max_positions_per_row)
+    logging.info(f"Arranging {n_positions} positions in {n_rows} rows and {n_cols} columns.")
+    
+    # Use the shape of the first image as reference.
+    sample_image = position_images[0]
+    cell_height, cell_width = sample_image.shape[:2]
+    output_tif_path = os.path.join(output_dir, f"{channel_name}.tif")
+    # Assemble the grid in a disk-backed memmap (assuming grayscale 16-bit images) so the OS pages it
+    # instead of committing the whole composite to RAM; cells past the last position stay blank (zero).
+    with tempfile.TemporaryFile(dir=output_dir) as backing:
+        composite_image = np.memmap(backing, dtype=np.uint16, mode='w+',
+                                    shape=(n_rows * cell_height, n_cols * cell_width))
+        # (row, y, col, x) view of the same buffer, so each position is one block copy.
+        grid = composite_image.reshape(n_rows, cell_height, n_cols, cell_width)
         for idx, img in enumerate(position_images):
-            row_idx = idx // max_positions_per_row
-            col_idx = idx % max_positions_per_row
-            y0 = row_idx * cell_height
-            x0 = col_idx * cell_width
-            # Ensure image dimensions match; if not, you may need to resize.
-            composite_image[y0:y0+cell_height, x0:x0+cell_width] = img
-        output_png_path = os.path.join(output_dir, f"{channel_name}.png")
-        imwrite(output_png_path, composite_image)
-        logging.info(f"Saved composite image for {channel_name} at {output_png_path}")
+            # All images must share the first image's shape.
+            grid[idx // n_cols, :, idx % n_cols, :] = img
+        composite_image.flush()
+        # Tiled, deflate-compressed TIFF: mostly-dark composites shrink several-fold and viewers can read tiles lazily.
+        # zlib rather than zstd so OpenCV's libtiff can still decode it in the black/white adjustment step.
+        imwrite(output_tif_path, composite_image, photometric='minisblack', compression='zlib', tile=(512, 512))
+        del grid, composite_image
+    logging.info(f"Saved composite image for {channel_name} at {output_tif_path}")
 
 def draw_labels_on_image(image, time_labels, position_labels, label_height, label_width):
     """
     Adds row (time) and column (position) labels to the composite image.
     """
-    image = (image / np.max(image) * 65535).astype(np.uint16)
+    # Scale to the full 16-bit range with one float32 intermediate instead of two float64 ones.
+    image = np.multiply(image, 65535.0 / np.max(image), dtype=np.float32).astype(np.uint16)
     pil_image = Image.fromarray(image)
     draw = ImageDraw.Draw(pil_image)
     
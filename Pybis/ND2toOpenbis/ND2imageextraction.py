@@ -3,78 +3,104 @@ import numpy as np
 from tifffile import imwrite
 from nd2 import ND2File
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from multiprocessing.util import Finalize
 
 logging.basicConfig(level=logging.INFO)
 
-def calculate_frame_index(dimensions, position_idx, t_idx, z_idx):
-    """Calculate the global frame index based on dimensions.
-    
-    For 3D samples: index = z_idx + position_idx * Z + t_idx * (P * Z)
-    For 2D samples (Z==1): index = position_idx + t_idx * P
+def frame_selection(dimensions, position_idx, t_idx, z_idx):
+    """Build an index tuple selecting one (T, P, Z) plane with all channels from a to_dask() array.
+
+    Axes follow the order of ``dimensions`` (ND2File.sizes); Y, X and C are kept whole.
+    """
+    wanted = {"T": t_idx, "P": position_idx, "Z": z_idx}
+    return tuple(wanted.get(axis, slice(None)) for axis in dimensions)
+
+# ND2 handle and its dask view, opened once per worker process by init_worker.
+_ND2 = None
+_ND2_ARRAY = None
+
+def init_worker(nd2_file):
+    """ProcessPoolExecutor initializer: open the ND2 file once for all positions handled by this worker."""
+    global _ND2, _ND2_ARRAY
+    _ND2 = ND2File(nd2_file)
+    _ND2_ARRAY = _ND2.to_dask()
+    # Pool workers skip atexit handlers, so close the file via multiprocessing's finalizers.
+    Finalize(None, _ND2.close, exitpriority=10)
+
+def write_position_planes(arr, position_idx, dimensions, z_index, time_indices, position_dir):
+    """Compute the selected (time, Z) planes of one position from a to_dask() array and save each channel as TIFF."""
+    import time
+
+    num_channels = dimensions.get('C', 1)
+    # Each (position, time) plane is computed once with all channels instead of once per channel.
+    plane_axes = [axis for axis in dimensions if axis not in ("T", "P", "Z")]
+    channel_axis = plane_axes.index("C") if "C" in plane_axes else None
+
+    # TIFF writes are queued on a small thread pool so they overlap with reading the next timepoint.
+    with ThreadPoolExecutor(max_workers=4) as writer:
+        pending_writes = []
+        for t_idx in dict.fromkeys(time_indices):
+            logging.info(f"Processing Position: {position_idx}, Time: {t_idx}")
+            t0 = time.time()
+            planes = arr[frame_selection(dimensions, position_idx, t_idx, z_index)].compute()
+            t1 = time.time()
+            logging.debug(f"Retrieved {num_channels} channel(s) in {t1 - t0:.2f} seconds")
+
+            if planes is None or planes.size == 0:
+                logging.warning(f"Empty or invalid image at Position={position_idx}, Time={t_idx}, Z={z_index}")
+                continue
+            for channel in range(num_channels):
+                frame = planes if channel_axis is None else np.take(planes, channel, axis=channel_axis)
+                filename = f"channel_{channel}_time_{t_idx}_z_{z_index}.tiff"
+                save_path = os.path.join(position_dir, filename)
+                pending_writes.append((save_path, writer.submit(imwrite, save_path, frame.astype(np.uint16, copy=False))))
+        for save_path, future in pending_writes:
+            future.result()
+            logging.info(f"Saved image to {save_path}")
+
+def extract_position(nd2_file, position_idx, dimensions, z_index, time_indices, save_dir, date, initials):
+    """Extract the selected timepoints of one position for all channels.
+
+    In a worker process this reuses the handle opened by init_worker; otherwise the file is opened here.
     """
-    z_dim = dimensions.get("Z", 1)
-    P = dimensions.get("P", 1)
-    if z_dim == 1:
-        return position_idx + t_idx * P
+    position_folder_name = f"{date}{initials}_p{position_idx + 1:04d}"
+    position_dir = os.path.join(save_dir, position_folder_name)
+    os.makedirs(position_dir, exist_ok=True)
+
+    if _ND2_ARRAY is not None:
+        write_position_planes(_ND2_ARRAY, position_idx, dimensions, z_index, time_indices, position_dir)
     else:
-        return z_idx + position_idx * z_dim + t_idx * P * z_dim
+        with ND2File(nd2_file) as nd2_data:
+            write_position_planes(nd2_data.to_dask(), position_idx, dimensions, z_index, time_indices, position_dir)
+    return position_idx
 
 def extract_images_with_nd2_plugin(nd2_file, save_dir="output", date="241203", initials="USER"):
     """
     Extracts the middle Z-stack for the first and last time points of each position for all channels,
     saving them as grayscale TIFF images.
     For 2D samples, it extracts the single available timepoint image.
+    Positions are extracted in parallel worker processes.
     """
-    from nd2 import ND2File  # Ensure ND2File is imported
-    from tifffile import imwrite
-    import numpy as np
-    import logging
-    import time
-
     with ND2File(nd2_file) as nd2_data:
-        dimensions = nd2_data.sizes
-        logging.info(f"ND2 Dimensions: {dimensions}")
-        num_channels = dimensions.get('C', 1)
-        logging.info(f"Number of channels: {num_channels}")
-        # Determine if sample is 2D (no Z) or 3D
-        if dimensions.get("Z", 1) == 1:
-            z_index = 0
-        else:
-            z_index = dimensions['Z'] // 2
-        time_indices = [0, dimensions['T'] - 1]
-        num_positions = dimensions.get('P', 1)
-        logging.info(f"Extracting from Middle Z: {z_index}, Time Points: {time_indices}, Positions: {num_positions}")
-        
-        # Loop through each position
-        for position_idx in range(num_positions):
-            position_folder_name = f"{date}{initials}_p{position_idx + 1:04d}"
-            position_dir = os.path.join(save_dir, position_folder_name)
-            os.makedirs(position_dir, exist_ok=True)
-            
-            for channel in range(num_channels):
-                logging.info(f"Processing Channel: {channel} at Position: {position_idx}")
-                for t_idx in time_indices:
-                    index = calculate_frame_index(dimensions, position_idx, t_idx, z_index)
-                    # Check if index is valid
-                    if index >= dimensions['T'] * dimensions['P'] * dimensions.get("Z", 1):
-                        logging.warning(f"Frame index {index} is out of range for Position={position_idx}, Time={t_idx}, Z={z_index}")
-                        continue
-                    
-                    logging.debug(f"Position {position_idx}, Channel {channel}, Time {t_idx}: Calculated frame index = {index}")
-                    t0 = time.time()
-                    frame = nd2_data._get_frame(index)
-                    t1 = time.time()
-                    logging.debug(f"Retrieved frame in {t1 - t0:.2f} seconds")
-                    
-                    if frame is None or frame.size == 0:
-                        logging.warning(f"Empty or invalid image at Position={position_idx}, Time={t_idx}, Z={z_index}")
-                        continue
-                    # For multi-channel 3D data, select the correct channel
-                    if frame.ndim == 3 and frame.shape[0] > 1:
-                        frame = frame[channel]
-                    filename = f"channel_{channel}_time_{t_idx}_z_{z_index}.tiff"
-                    save_path = os.path.join(position_dir, filename)
-                    imwrite(save_path, frame.astype(np.uint16))
-                    logging.info(f"Saved image to {save_path}")
-
+        dimensions = dict(nd2_data.sizes)
+    logging.info(f"ND2 Dimensions: {dimensions}")
+    num_channels = dimensions.get('C', 1)
+    logging.info(f"Number of channels: {num_channels}")
+    # Determine if sample is 2D (no Z) or 3D
+    if dimensions.get("Z", 1) == 1:
+        z_index = 0
+    else:
+        z_index = dimensions['Z'] // 2
+    time_indices = [0, dimensions['T'] - 1]
+    num_positions = dimensions.get('P', 1)
+    logging.info(f"Extracting from Middle Z: {z_index}, Time Points: {time_indices}, Positions: {num_positions}")
 
+    num_workers = max(1, min(num_positions, os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker,
+                             initargs=(nd2_file,)) as executor:
+        for position_idx in executor.map(
+                extract_position, repeat(nd2_file), range(num_positions), repeat(dimensions),
+                repeat(z_index), repeat(time_indices), repeat(save_dir), repeat(date), repeat(initials)):
+            logging.info(f"Finished Position: {position_idx}")
@@ -1,7 +1,39 @@
 import os
-import xml.etree.ElementTree as ET
 import logging
 import re
+from xml.sax.saxutils import escape
+
+# Attribute escaping as done by ElementTree.
+_ATTR_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"}
+
+# Stage positions, e.g. "ImageMetadataLV|SLxExperiment|ppNextLevelEx|i0000000000|uLoopPars|Points|i000000000i|dPosX".
+# The outer i0000000000 is the experiment index (often 0 if there's only one experiment),
+# while the inner iXXXXXXXXXX is the position index, zero-padded to 10 digits.
+POINTS_PREFIX = "ImageMetadataLV|SLxExperiment|ppNextLevelEx|i0000000000|uLoopPars|Points|i"
+OBJECTIVE_RE = re.compile(r"(\d+)")
+POINT_KEY_RE = re.compile(re.escape(POINTS_PREFIX) + r"(\d{10})\|dPos([XY])")
+
+def read_stage_positions(flattened_metadata, num_positions):
+    """Collect the X/Y stage position of each position in one pass over the metadata ("0" if missing)."""
+    positions = {"X": ["0"] * num_positions, "Y": ["0"] * num_positions}
+    for key, value in flattened_metadata.items():
+        if not key.startswith(POINTS_PREFIX):
+            continue
+        match = POINT_KEY_RE.fullmatch(key)
+        if match:
+            idx = int(match.group(1))
+            if idx < num_positions:
+                positions[match.group(2)][idx] = value
+    return positions["X"], positions["Y"]
+
+def escape_attr(value):
+    """Escape a value for use inside a double-quoted XML attribute."""
+    return escape(str(value), _ATTR_ENTITIES)
+
+def empty_element(tag, **attrib):
+    """Serialize an empty element with attributes, formatted like ElementTree's short empty elements."""
+    attrs = "".join(f' {name}="{escape_attr(value)}"' for name, value in attrib.items())
+    return f"<{tag}{attrs} />"
 
 def create_tatexp_xml(
     flattened_metadata,
@@ -36,83 +68,66 @@ def create_tatexp_xml(
     height = flattened_metadata.get("ImageAttributesLV|SLxImageAttributes|uiHeight", 512)
     # ND2 might store objective in "ImageCalibrationLV|0|SLxCalibration|Objective"
     objective = flattened_metadata.get("ImageCalibrationLV|0|SLxCalibration|Objective", "4")
-    match = re.search(r"(\d+)", objective)
+    match = OBJECTIVE_RE.search(objective)
     if match:
         objective_value = match.group(1)
     else:
         objective_value = "4"
 
 
-    # Build the XML
-    root = ET.Element("TATSettings")
+    # Build the XML as text. Every element except the root is a flat, empty tag with short
+    # attribute values, so formatting lines directly avoids building an Element per position.
+    # The output matches ElementTree's serialization of the same tree.
+    parts = [
+        "<TATSettings>",
+        # Version
+        "<TTTConvertExperimentVersion>160304</TTTConvertExperimentVersion>",
+        # Positions
+        empty_element("PositionCount", count=num_positions),
+        "<PositionData>",
+    ]
     
-    # Version
-    version = ET.SubElement(root, "TTTConvertExperimentVersion")
-    version.text = "160304"
-    
-    # Positions
-    ET.SubElement(root, "PositionCount", attrib={"count": str(num_positions)})
-    position_data = ET.SubElement(root, "PositionData")
-    
-    for i in range(num_positions):
-        # Example: For position i, the flattened metadata keys might be:
-        # "ImageMetadataLV|SLxExperiment|ppNextLevelEx|i0000000000|uLoopPars|Points|i000000000i|dPosX"
-        # The outer i0000000000 is the experiment index (often 0 if there's only one experiment),
-        # while the inner iXXXXXXXXXX is the position index, zero-padded to 10 digits.
-        key_x = f"ImageMetadataLV|SLxExperiment|ppNextLevelEx|i0000000000|uLoopPars|Points|i{i:010d}|dPosX"
-        key_y = f"ImageMetadataLV|SLxExperiment|ppNextLevelEx|i0000000000|uLoopPars|Points|i{i:010d}|dPosY"
-        pos_x = flattened_metadata.get(key_x, "0")
-        pos_y = flattened_metadata.get(key_y, "0")
-        
-        pos_info = ET.SubElement(position_data, "PositionInformation")
-        ET.SubElement(
-            pos_info,
-            "PosInfoDimension",
-            attrib={
-                "index": f"{i+1:04d}",  # e.g. 0001, 0002, etc.
-                "posX": str(pos_x),
-                "posY": str(pos_y),
-                "comments": ""
-            }
+    positions_x, positions_y = read_stage_positions(flattened_metadata, num_positions)
+    for i, (pos_x, pos_y) in enumerate(zip(positions_x, positions_y)):
+        # index e.g. 0001, 0002, etc.
+        parts.append(
+            f'<PositionInformation><PosInfoDimension index="{i+1:04d}" '
+            f'posX="{escape_attr(pos_x)}" posY="{escape_attr(pos_y)}" comments="" /></PositionInformation>'
         )
+    parts.append("</PositionData>")
     
     # Wavelengths
-    ET.SubElement(root, "WavelengthCount", attrib={"count": str(num_channels)})
-    wavelength_data = ET.SubElement(root, "WavelengthData")
-    
+    parts.append(empty_element("WavelengthCount", count=num_channels))
+    parts.append("<WavelengthData>")
     for ch in range(num_channels):
-        wl_info = ET.SubElement(wavelength_data, "WavelengthInformation")
-        ET.SubElement(
-            wl_info,
-            "WLInfo",
-            attrib={
-                "ImageType": "png",
-                "Name": f"{ch:02d}",  # "00", "01", etc.
-                "height": str(height),
-                "width": str(width)
-            }
-        )
+        parts.append("<WavelengthInformation>")
+        # Name: "00", "01", etc.
+        parts.append(empty_element("WLInfo", ImageType="png", Name=f"{ch:02d}", height=height, width=width))
+        parts.append("</WavelengthInformation>")
+    parts.append("</WavelengthData>")
     
     # Objective
-    ET.SubElement(root, "CurrentObjectiveMagnification", attrib={"value": str(objective_value)})
+    parts.append(empty_element("CurrentObjectiveMagnification", value=objective_value))
     # Often 1.0 for the TV adapter
-    ET.SubElement(root, "CurrentTVAdapterMagnification", attrib={"value": "1.0"})
+    parts.append(empty_element("CurrentTVAdapterMagnification", value="1.0"))
     
     # Minimal "CellsAndConditions" block
-    cells_conditions = ET.SubElement(root, "CellsAndConditions")
-    ET.SubElement(cells_conditions, "NumberOfCellTypes", attrib={"value": "1"})
-    cact_cell_types = ET.SubElement(cells_conditions, "CellsAndConditions_CellTypes")
-    cts_cell_type = ET.SubElement(cact_cell_types, "CNC_CTs_CellType")
+    parts.append("<CellsAndConditions>")
+    parts.append(empty_element("NumberOfCellTypes", value="1"))
+    parts.append("<CellsAndConditions_CellTypes><CNC_CTs_CellType>")
     for tag in ["PrimaryCell", "Name", "Species", "Sex", "Organ", "Age", "Purification", "Comment"]:
-        ET.SubElement(cts_cell_type, tag, attrib={"value": ""})
+        parts.append(empty_element(tag, value=""))
+    parts.append("</CNC_CTs_CellType></CellsAndConditions_CellTypes>")
+    parts.append("</CellsAndConditions>")
+    parts.append("</TATSettings>")
     
-    # Build final tree
-    tree = ET.ElementTree(root)
     # Example naming: "250301AK35_TATexp.xml"
     xml_filename = f"{date_str}{user_str}{setup_number}_TATexp.xml"
     final_path = os.path.join(output_dir, xml_filename)
     
     # Write with XML declaration
-    tree.write(final_path, encoding="utf-8", xml_declaration=True)
+    with open(final_path, "w", encoding="utf-8") as f:
+        f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        f.write("".join(parts))
     logging.info(f"TATexp.xml created at: {final_path}")
     return final_path
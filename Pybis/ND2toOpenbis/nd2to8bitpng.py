@@ -1,8 +1,11 @@
 import os
 import json
+import functools
+import queue
+import threading
 import numpy as np
-from tifffile import imwrite
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 from nd2 import ND2File
 import logging
 
@@ -13,50 +16,103 @@ def load_black_white_points(json_path):
     with open(json_path, "r") as f:
         return json.load(f)
 
+@functools.lru_cache(maxsize=16)
+def black_white_lut(vmin, vmax):
+    """16-bit -> 8-bit lookup table for the given black/white points (shared, read-only)."""
+    levels = np.arange(65536, dtype=np.float64)
+    lut = ((np.clip(levels, vmin, vmax) - vmin) / max(1, vmax - vmin) * 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
 def adjust_image_to_black_white(image, vmin, vmax):
     """Adjust the image to new black and white points and convert to 8-bit."""
+    if image.dtype == np.uint16:
+        # One table lookup per pixel instead of clip, subtract, divide and cast over float64 temporaries.
+        return np.take(black_white_lut(vmin, vmax), image)
     adjusted = np.clip(image, vmin, vmax)
     adjusted_8bit = ((adjusted - vmin) / max(1, vmax - vmin) * 255).astype(np.uint8)
     return adjusted_8bit
 
-def calculate_frame_index3D(dimensions, position_idx, t_idx, z_idx):
-    return z_idx + position_idx * dimensions['Z'] + t_idx * dimensions['P'] * dimensions['Z']
+# zlib level 1 is the speed sweet spot for PNG: far less CPU than the default 6 for slightly larger files.
+PNG_FAST_LEVEL = 1
+
+def compress_level_from_percent(compression_percent):
+    """Map compression_percent (0-100; 100 = least compression) to a PNG level: fast 1, default 6 or max 9."""
+    if compression_percent >= 90:
+        return PNG_FAST_LEVEL
+    if compression_percent >= 40:
+        return 6
+    return 9
+
+def encode_png(image, compress_level):
+    """Encode an 8-bit image as PNG with the given compression level (0 = no compression, 9 = maximum)."""
+    # OpenCV releases the GIL while encoding.
+    ok, png = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, compress_level])
+    if not ok:
+        raise ValueError("PNG encoding failed")
+    return png
+
+@functools.lru_cache(maxsize=64)
+def constant_png(shape, value, compress_level):
+    """Encoded PNG of a uniform 8-bit image, cached for blank or saturated frames."""
+    return encode_png(np.full(shape, value, dtype=np.uint8), compress_level)
 
-def calculate_frame_index2D(dimensions, position_idx, t_idx, z_idx):
-    return position_idx + t_idx * dimensions['P']
+def convert_frame(frame, vmin, vmax, compress_level):
+    """Adjust one single-channel frame and encode it as an 8-bit PNG, returning the encoded bytes."""
+    # The black/white mapping is monotonic, so if the darkest and brightest pixels map to the same
+    # 8-bit value the whole frame does (e.g. empty or fully saturated); reuse a cached PNG for it.
+    lo, hi = adjust_image_to_black_white(np.array([frame.min(), frame.max()], dtype=frame.dtype), vmin, vmax)
+    if lo == hi:
+        return constant_png(frame.shape, int(lo), compress_level)
+    return encode_png(adjust_image_to_black_white(frame, vmin, vmax), compress_level)
 
-def process_single_frame(nd2_file_path, position_idx, t_idx, z_idx, channel, vmin, vmax, save_path, compress_level):
-    """Process a single frame: read, adjust, and save as an 8-bit PNG with specified compression."""
+def process_frame(frame, vmin, vmax, save_path, compress_level, write_queue):
+    """
+    Thread-pool task: encode one prefetched frame and queue it for the writer thread.
+    Returns None once queued (the writer reports whether it was saved), or an error message.
+    """
     try:
-        with ND2File(nd2_file_path) as nd2_data:
-            dimensions = nd2_data.sizes
-            # Choose frame index calculation based on whether the file is 2D or 3D.
-            if dimensions.get("Z", 1) == 1:
-                frame_index = calculate_frame_index2D(dimensions, position_idx, t_idx, z_idx)
-            else:
-                frame_index = calculate_frame_index3D(dimensions, position_idx, t_idx, z_idx)
-            frame = nd2_data._get_frame(frame_index)
-            if frame is None or frame.size == 0:
-                logging.warning(f"Empty frame at P={position_idx}, T={t_idx}, Z={z_idx}")
-                return f"Empty frame at P={position_idx}, T={t_idx}, Z={z_idx}"
-            if frame.ndim == 3 and frame.shape[0] > 1:
-                frame = frame[channel]
-            adjusted_image = adjust_image_to_black_white(frame, vmin, vmax)
-            # Save using the provided compression level (0 = no compression, 9 = maximum)
-            imwrite(save_path, adjusted_image, compress=compress_level)
-        return f"Processed and saved: {save_path}"
+        write_queue.put((save_path, convert_frame(frame, vmin, vmax, compress_level)))
+        return None
     except Exception as e:
-        return f"Error processing frame P={position_idx}, T={t_idx}, Z={z_idx}, C={channel}: {e}"
+        return f"Error processing {save_path}: {e}"
 
-def process_nd2_images_multithreaded(nd2_file_path, output_dir, black_white_points_path, date, initials, compression_percent=100, progress_callback=None):
-    """Process images from an ND2 file using multithreading with adjustable PNG compression."""
+def write_files(write_queue, write_results):
+    """Writer thread: save queued (path, bytes) pairs until a None sentinel arrives, recording each outcome."""
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+        save_path, data = item
+        try:
+            # Writing the buffer ourselves (rather than cv2.imwrite) also handles non-ASCII paths.
+            with open(save_path, "wb") as f:
+                f.write(data)
+            write_results.append(f"Processed and saved: {save_path}")
+        except Exception as e:
+            write_results.append(f"Error writing {save_path}: {e}")
+
+def process_nd2_images_multithreaded(nd2_file_path, output_dir, black_white_points_path, date, initials, compression_percent=100, progress_callback=None, compress_level=None, num_workers=None):
+    """
+    Process images from an ND2 file with adjustable PNG compression.
+
+    The ND2 file is opened once, here, and read frame by frame in file order (the reader is not
+    reentrant). Each channel plane is handed to a thread pool for black/white adjustment and
+    encoding; NumPy and zlib release the GIL, so the threads run in parallel without process
+    startup or pickling. A single writer thread saves the encoded PNGs, so encoders never wait on disk.
+
+    compress_level (0-9) is used as-is when given; otherwise it is derived from compression_percent.
+    num_workers defaults to one encoder thread per CPU.
+    """
     black_white_points = load_black_white_points(black_white_points_path)
     results = []
 
-    # Map compression_percent (0-100) to PNG compression level (0-9)
-    # Here, 100% means no compression (compress level 0) and 0% means max compression (compress level 9).
-    compress_level = round((100 - compression_percent) / 100 * 9)
-    logging.info(f"Using PNG compression level: {compress_level} (from {compression_percent}%)")
+    # PNG levels: 0 = stored (no compression), 1 = fastest, 6 = zlib default, 9 = smallest.
+    if compress_level is None:
+        compress_level = compress_level_from_percent(compression_percent)
+        logging.info(f"Using PNG compression level: {compress_level} (from {compression_percent}%)")
+    else:
+        logging.info(f"Using PNG compression level: {compress_level}")
     
     with ND2File(nd2_file_path) as nd2_data:
         dimensions = nd2_data.sizes
@@ -66,32 +122,122 @@ def process_nd2_images_multithreaded(nd2_file_path, output_dir, black_white_poin
         num_stacks = dimensions.get("Z", 1)
         num_channels = dimensions.get("C", 1)
         
-        tasks = []
+        # Output paths are assembled from precomputed pieces:
+        # <position folder>/<date><initials>_pPPPP + _tTTTTT_zZZZ + _wCC.png
+        position_prefixes = []
+        os.makedirs(output_dir, exist_ok=True)
         for position_idx in range(num_positions):
-            position_folder = os.path.join(output_dir, f"{date}{initials}_p{position_idx + 1:04d}")
-            os.makedirs(position_folder, exist_ok=True)
-            for t_idx in range(num_timepoints):
-                for z_idx in range(num_stacks):
-                    for channel in range(num_channels):
-                        filename = f"{date}{initials}_p{position_idx + 1:04d}_t{t_idx + 1:05d}_z{z_idx + 1:03d}_w{channel:02d}.png"
-                        save_path = os.path.join(position_folder, filename)
-                        vmin = black_white_points.get(f"Channel_{channel}", {}).get("Min", 0)
-                        vmax = black_white_points.get(f"Channel_{channel}", {}).get("Max", 65535)
-                        tasks.append((position_idx, t_idx, z_idx, channel, vmin, vmax, save_path, compress_level))
-        
-        total_tasks = len(tasks)
+            position_name = f"{date}{initials}_p{position_idx + 1:04d}"
+            position_folder = os.path.join(output_dir, position_name)
+            try:
+                # output_dir was created above; a plain mkdir skips makedirs' per-level checks.
+                os.mkdir(position_folder)
+            except FileExistsError:
+                pass
+            position_prefixes.append(position_folder + os.sep + position_name)
+        channel_suffixes = [f"_w{channel:02d}.png" for channel in range(num_channels)]
+        channel_points = []
+        for channel in range(num_channels):
+            points = black_white_points.get(f"Channel_{channel}", {})
+            channel_points.append((points.get("Min", 0), points.get("Max", 65535)))
+        # Build each channel's black/white table once up front, rather than having several encoder
+        # threads race to build the same table on their first frame.
+        for vmin, vmax in channel_points:
+            black_white_lut(vmin, vmax)
+
+        total_tasks = num_positions * num_timepoints * num_stacks * num_channels
         logging.info(f"Total tasks to process: {total_tasks}")
-        num_workers = os.cpu_count()
+        if num_workers is None:
+            num_workers = os.cpu_count()
         logging.info(f"Using {num_workers} parallel workers for processing.")
 
-        with ProcessPoolExecutor(max_workers=num_workers) as executor:
-            futures = [executor.submit(process_single_frame, nd2_file_path, *task)
-                       for task in tasks]
-            for i, future in enumerate(as_completed(futures), 1):
+        # Two queued planes per worker keep every thread busy while bounding memory use.
+        max_in_flight = 2 * num_workers
+        in_flight = set()
+        # Bounded, so encoding backs off if the disk falls behind.
+        write_queue = queue.Queue(maxsize=max_in_flight)
+        write_results = []
+        writer = threading.Thread(target=write_files, args=(write_queue, write_results), daemon=True)
+        writer.start()
+
+        # Frames encoded (or found empty) so far; saving is reported by the writer thread.
+        completed = 0
+
+        def collect(return_when):
+            nonlocal completed
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                in_flight.discard(future)
+                message = future.result()
+                if message is not None:
+                    results.append(message)
+                completed += 1
                 if progress_callback:
-                    progress_callback(f"Converting image {i} of {total_tasks}", i, total_tasks)
-                try:
-                    results.append(future.result())
-                except Exception as e:
-                    results.append(f"Error: {e}")
+                    progress_callback(f"Converting image {completed} of {total_tasks}", completed, total_tasks)
+
+        try:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                # T, P, Z order matches the frame layout in the file, so reads are sequential.
+                # Frame index = (t * P + p) * Z + z, for 2D (Z == 1) and 3D files alike.
+                for t_idx in range(num_timepoints):
+                    for position_idx in range(num_positions):
+                        position_base = (t_idx * num_positions + position_idx) * num_stacks
+                        for z_idx in range(num_stacks):
+                            frame_index = position_base + z_idx
+                            try:
+                                frame = nd2_data._get_frame(frame_index)
+                            except Exception as e:
+                                frame = None
+                                logging.error(f"Error reading frame P={position_idx}, T={t_idx}, Z={z_idx}: {e}")
+                            if frame is None or frame.size == 0:
+                                logging.warning(f"Empty frame at P={position_idx}, T={t_idx}, Z={z_idx}")
+                                results.extend([f"Empty frame at P={position_idx}, T={t_idx}, Z={z_idx}"] * num_channels)
+                                completed += num_channels
+                                continue
+                            frame_prefix = f"{position_prefixes[position_idx]}_t{t_idx + 1:05d}_z{z_idx + 1:03d}"
+                            for channel in range(num_channels):
+                                plane = frame[channel] if frame.ndim == 3 and frame.shape[0] > 1 else frame
+                                if len(in_flight) >= max_in_flight:
+                                    collect(FIRST_COMPLETED)
+                                vmin, vmax = channel_points[channel]
+                                in_flight.add(executor.submit(
+                                    process_frame, plane, vmin, vmax,
+                                    frame_prefix + channel_suffixes[channel], compress_level, write_queue))
+                if in_flight:
+                    collect(ALL_COMPLETED)
+        finally:
+            # Always stop the writer, after it has flushed everything queued so far.
+            write_queue.put(None)
+            writer.join()
+        results.extend(write_results)
     return results
+
+def process_nd2_batch(jobs, max_pipelines=2, compression_percent=100, progress_callback=None, compress_level=None):
+    """
+    Convert several ND2 files, running up to max_pipelines files concurrently so one file's
+    sequential reads overlap another's encoding. The CPUs are split between the running files.
+
+    Args:
+        jobs: Iterable of (nd2_file_path, output_dir, black_white_points_path, date, initials) tuples.
+    Returns:
+        dict: nd2_file_path -> list of result messages from process_nd2_images_multithreaded.
+    """
+    jobs = list(jobs)
+    if not jobs:
+        return {}
+    pipelines = max(1, min(max_pipelines, len(jobs)))
+    workers_per_file = max(1, (os.cpu_count() or 1) // pipelines)
+    logging.info(f"Converting {len(jobs)} ND2 files, {pipelines} at a time with {workers_per_file} workers each.")
+
+    def run(job):
+        nd2_file_path = job[0]
+        file_progress = None
+        if progress_callback:
+            name = os.path.basename(nd2_file_path)
+            file_progress = lambda msg, current, total: progress_callback(f"{name}: {msg}", current, total)
+        return process_nd2_images_multithreaded(
+            *job, compression_percent=compression_percent, progress_callback=file_progress,
+            compress_level=compress_level, num_workers=workers_per_file)
+
+    with ThreadPoolExecutor(max_workers=pipelines) as executor:
+        return dict(zip((job[0] for job in jobs), executor.map(run, jobs)))
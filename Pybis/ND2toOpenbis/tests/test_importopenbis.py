@@ -0,0 +1,52 @@
+import os
+import sys
+
+import pytest
+
+# The pipeline modules are plain scripts imported by name from their own folder.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("nd2")
+pytest.importorskip("pybis")
+pytest.importorskip("requests")
+
+import ImportOpenBIS
+
+
+class StubOpenbis:
+    """Minimal stand-in for pybis.Openbis that counts experiment lookups."""
+
+    token = "stub-token"
+
+    def __init__(self):
+        self.get_experiment_calls = 0
+
+    def get_experiment(self, identifier):
+        self.get_experiment_calls += 1
+        return {"identifier": identifier}
+
+
+def test_get_experiment_cached_fetches_once(monkeypatch):
+    monkeypatch.setattr(ImportOpenBIS, "_experiment_cache", {})
+    openbis = StubOpenbis()
+
+    first = ImportOpenBIS.get_experiment_cached(openbis, "/SPACE/PROJECT/EXP1")
+    second = ImportOpenBIS.get_experiment_cached(openbis, "/SPACE/PROJECT/EXP1")
+
+    assert first == {"identifier": "/SPACE/PROJECT/EXP1"}
+    assert second is first
+    assert openbis.get_experiment_calls == 1
+
+
+def test_identical_upload_is_skipped(tmp_path):
+    csv_path = tmp_path / "metadata.csv"
+    csv_path.write_text("key,value\n")
+    manifest = {"/SPACE/PROJECT/EXP1": ImportOpenBIS.upload_fingerprint([str(csv_path)], "info", "<p/>")}
+    (tmp_path / ImportOpenBIS.UPLOAD_MANIFEST_NAME).write_text(ImportOpenBIS.json.dumps(manifest))
+    openbis = StubOpenbis()
+
+    status = ImportOpenBIS.create_experimental_step_with_dataset(
+        openbis, "/SPACE/PROJECT/EXP1", "step", "info", str(csv_path), [], "<p/>")
+
+    assert status == ImportOpenBIS.UPLOAD_SKIPPED
+    assert openbis.get_experiment_calls == 0